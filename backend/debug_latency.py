@@ -3,6 +3,7 @@ import sys
 import numpy as np
 import pretty_midi
 import soundfile as sf
+import tempfile
 import time
 
 # Add cwd to path to find services
@@ -22,35 +23,44 @@ def test_latency():
     inst.notes.append(note)
     midi.instruments.append(inst)
     
-    midi_filename = "test_latency.mid"
+    # Keep the scratch files on tmpfs where available so disk I/O stays out of the way
+    scratch_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    with tempfile.NamedTemporaryFile(suffix=".mid", dir=scratch_dir, delete=False) as tmp:
+        midi_filename = tmp.name
+    with tempfile.NamedTemporaryFile(suffix=".wav", dir=scratch_dir, delete=False) as tmp:
+        wav_filename = tmp.name
     midi.write(midi_filename)
     print(f"Created {midi_filename}")
 
     # 2. Render to WAV
     print("Rendering to WAV...")
-    wav_path = render_midi_to_wav(midi_filename, instrument="Piano")
+    wav_path = render_midi_to_wav(midi_filename, instrument="Piano", output_path=wav_filename)
     print(f"Rendered to {wav_path}")
 
-    # 3. Analyze WAV for silence
-    audio, samplerate = sf.read(wav_path)
-    print(f"Loaded WAV. Samplerate: {samplerate}, Channels: {audio.ndim}")
-
-    # Convert to mono if stereo
-    if audio.ndim > 1:
-        audio = np.mean(audio, axis=1)
-
-    # Find first sample > threshold
+    # 3. Analyze WAV for silence, streaming it block by block so we only
+    # read as far as the first non-silent sample
     threshold = 0.01 # -40dB approx
-    indices = np.where(np.abs(audio) > threshold)[0]
-
-    if len(indices) == 0:
-        print("Detailed Error: Rendered audio is silent!")
-        return
-
-    first_sample = indices[0]
-    latency_ms = (first_sample / samplerate) * 1000
-    print(f"First non-silent sample at: {first_sample}")
-    print(f"Latency: {latency_ms:.2f} ms")
+    block_size = 4096
+    first_sample = None
+    with sf.SoundFile(wav_path) as f:
+        samplerate = f.samplerate
+        print(f"Opened WAV. Samplerate: {samplerate}, Channels: {f.channels}")
+        # Reused boolean masks: compare against +/-threshold directly instead of
+        # materializing an abs() copy of every block
+        loud = np.empty((block_size, f.channels), dtype=bool)
+        loud_neg = np.empty_like(loud)
+        for i, block in enumerate(f.blocks(blocksize=block_size, dtype="float32", always_2d=True)):
+            n = len(block)
+            np.greater(block, threshold, out=loud[:n])
+            np.less(block, -threshold, out=loud_neg[:n])
+            np.logical_or(loud[:n], loud_neg[:n], out=loud[:n])
+            # A frame counts as soon as either channel is loud enough
+            frames = loud[:n].any(axis=1)
+            hit = int(np.argmax(frames))
+            # argmax returns 0 for an all-quiet block, so confirm the hit
+            if frames[hit]:
+                first_sample = i * block_size + hit
+                break
 
     # Cleanup
     try:
@@ -59,5 +69,13 @@ def test_latency():
     except:
         pass
 
+    if first_sample is None:
+        print("Detailed Error: Rendered audio is silent!")
+        return
+
+    latency_ms = (first_sample / samplerate) * 1000
+    print(f"First non-silent sample at: {first_sample}")
+    print(f"Latency: {latency_ms:.2f} ms")
+
 if __name__ == "__main__":
     test_latency()
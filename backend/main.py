@@ -6,8 +6,25 @@ Run with:
     uvicorn main:app --reload --port 8000
 """
 
+import asyncio
+import copy
+import io
 import os
 import sys
+import tempfile
+import time
+import traceback
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import lru_cache, partial
+
+import aiofiles
+import httpx
+import numpy as np
+import orjson
+import pretty_midi
 
 # Ensure the backend directory is on the path so local imports work
 sys.path.insert(0, os.path.dirname(__file__))
@@ -19,25 +36,34 @@ try:
 except ImportError:
     pass
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import FileResponse
+# librosa's numba kernels are compiled with cache=True; keep that cache somewhere
+# writable (site-packages often isn't) so restarts reuse it. Must precede librosa imports.
+os.environ.setdefault("NUMBA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "sinatra-numba"))
+
+from dataclasses import asdict, dataclass, fields
+from fastapi import Depends, FastAPI, UploadFile, File, HTTPException, Form, Query, Request
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Literal, Optional
 
 # Import services with error handling
 try:
-    from services.bpm import detect_bpm
+    from services.bpm import detect_bpm, warm_up as warm_up_bpm
 except ImportError as e:
     print(f"⚠️ Warning: Could not import bpm service: {e}")
     detect_bpm = None
+    warm_up_bpm = None
 
 try:
-    from services.transcription import vocal_to_midi
+    from services.transcription import run_model as run_transcription_model, vocal_to_midi, warm_up as warm_up_transcription
 except Exception as e:
     print(f"⚠️ Warning: Could not import transcription service: {type(e).__name__}: {e}")
+    run_transcription_model = None
     vocal_to_midi = None
+    warm_up_transcription = None
 
 try:
     from services.chords import generate_chord_progression
@@ -46,25 +72,61 @@ except ImportError as e:
     generate_chord_progression = None
 
 try:
-    from services.synth import INSTRUMENT_PROGRAMS, render_midi_to_wav
+    from services.sampler import detect_base_pitch, render_with_sample, warm_up as warm_up_sampler
+except ImportError as e:
+    print(f"⚠️ Warning: Could not import sampler service: {e}")
+    detect_base_pitch = None
+    render_with_sample = None
+    warm_up_sampler = None
+
+try:
+    from librosa import midi_to_note
+except ImportError as e:
+    print(f"⚠️ Warning: Could not import librosa: {e}")
+    midi_to_note = None
+
+try:
+    from services.synth import (
+        INSTRUMENT_PROGRAMS,
+        downmix_to_preview,
+        render_midi_to_wav,
+        stop_render_worker,
+        warm_up as warm_up_synth,
+    )
 except ImportError as e:
     print(f"⚠️ Warning: Could not import synth service: {e}")
     INSTRUMENT_PROGRAMS = {}
+    downmix_to_preview = None
     render_midi_to_wav = None
+    stop_render_worker = None
+    warm_up_synth = None
 
 try:
-    from services.chat import chat as gemini_chat, clear_history as clear_chat_history
+    from services.chat import (
+        chat as gemini_chat,
+        chat_stream as gemini_chat_stream,
+        clear_history as clear_chat_history,
+        close_client as close_chat_client,
+    )
 except ImportError as e:
     print(f"⚠️ Warning: Could not import chat service: {e}")
     gemini_chat = None
+    gemini_chat_stream = None
     clear_chat_history = None
+    close_chat_client = None
 
 try:
-    from utils.file_helpers import save_upload, validate_wav, cleanup_file, UPLOAD_DIR
+    from utils.file_helpers import (
+        save_upload_hashed, validate_wav, cleanup_file, generate_filepath, UPLOAD_DIR,
+        render_cache_path, cache_fetch, cache_store,
+    )
 except ImportError as e:
     print(f"❌ Error: Could not import file helpers: {e}")
     raise  # This is critical, so we raise
 
+from utils.gzip_middleware import JSONGZipMiddleware
+from utils.session_store import AnalysisStore, SessionStore
+
 # Verify Basic Pitch is available at startup
 try:
     from basic_pitch import ICASSP_2022_MODEL_PATH
@@ -81,13 +143,72 @@ except ImportError as e:
     print("   Run: pip install basic-pitch==0.4.0 --no-deps")
     print("=" * 60)
 
-app = FastAPI(title="Sinatra", version="0.1.0")
+# orjson serializes the JSON endpoints (chat, health, uploads) in C instead of stdlib json
+app = FastAPI(title="Sinatra", version="0.1.0", default_response_class=ORJSONResponse)
+
+# Blocking pipeline stages (librosa, Basic Pitch, FluidSynth) run on this pool.
+# Threads rather than processes: the heavy work is native code that releases the
+# GIL, and threads share the warmed-up model, session state and render cache.
+PIPELINE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="pipeline")
+
+
+async def _run_in_pool(fn, *args, **kwargs):
+    """Run a blocking pipeline stage on PIPELINE_POOL without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(PIPELINE_POOL, partial(fn, *args, **kwargs))
+
+
+# HTTP/2 lets repeated hydrates multiplex over one TLS connection (needs httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Shared client for fetching remote files (e.g. /hydrate-midi), reusing connections
+HTTP_CLIENT = httpx.AsyncClient(timeout=30.0, follow_redirects=True, http2=HTTP2_AVAILABLE)
+
+# Size of each chunk streamed from a remote download to disk
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
 
 # Startup event to catch initialization errors
+# Set once startup warm-up has finished; /health reports it for readiness probes
+_warmed_up = False
+# Background tasks started at startup (referenced here so they aren't garbage-collected)
+_warm_up_task: Optional[asyncio.Task] = None
+_session_sweeper: Optional[asyncio.Task] = None
+_artifact_sweeper: Optional[asyncio.Task] = None
+
+
+async def _warm_up() -> None:
+    """
+    Run one inference and one render per instrument, so the first upload doesn't
+    pay for model setup or SoundFont paging; then mark the app ready.
+    """
+    global _warmed_up
+    warm_ups = {
+        "Basic Pitch": warm_up_transcription,
+        "FluidSynth": warm_up_synth,
+        "BPM detection": warm_up_bpm,
+        "Sample pitch detection": warm_up_sampler,
+    }
+    warm_ups = {name: fn for name, fn in warm_ups.items() if fn is not None}
+    print(f"🔥 Warming up {', '.join(warm_ups) or 'nothing'}...")
+    results = await asyncio.gather(
+        *(_run_in_pool(fn) for fn in warm_ups.values()), return_exceptions=True
+    )
+    for name, result in zip(warm_ups, results):
+        if isinstance(result, BaseException):
+            print(f"⚠️ {name} warm-up failed: {result}")
+        else:
+            print(f"✅ {name} warmed up")
+    _warmed_up = True
+    print("✅ Warm-up finished, ready")
+
+
 @app.on_event("startup")
 async def startup_event():
     """Log startup information and catch any initialization errors."""
-    import traceback
     try:
         print("=" * 60)
         print("🚀 Sinatra Backend Starting...")
@@ -96,100 +217,500 @@ async def startup_event():
         print(f"🔑 GEMINI_API_KEY set: {bool(os.getenv('GEMINI_API_KEY'))}")
         print(f"🌐 PORT: {os.getenv('PORT', 'NOT SET')}")
         print("=" * 60)
+        # Warm up in the background: the app serves (and /health answers) right
+        # away, and reports ready once the first upload won't pay for setup
+        global _warm_up_task, _session_sweeper, _artifact_sweeper
+        _warm_up_task = asyncio.create_task(_warm_up())
+        _session_sweeper = asyncio.create_task(_expire_sessions())
+        _artifact_sweeper = asyncio.create_task(_expire_artifacts())
         print("✅ App initialized successfully!")
     except Exception as e:
         print(f"❌ Startup error: {e}")
         print(traceback.format_exc())
         # Don't raise - let the app start so we can see the error
 
-# Allow the frontend (Vite dev server) to call us
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in (_warm_up_task, _session_sweeper, _artifact_sweeper):
+        if task is not None:
+            task.cancel()
+    PIPELINE_POOL.shutdown(wait=False, cancel_futures=True)
+    await HTTP_CLIENT.aclose()
+    if close_chat_client is not None:
+        await close_chat_client()
+    _session_store.close()
+    _analysis_store.close()
+    if stop_render_worker is not None:
+        stop_render_worker()
+
+# Allow the frontend (Vite dev server and the deployed app) to call us.
+# Explicit origins/methods/headers instead of "*": Starlette then answers preflights
+# from a fixed header set, and browsers cache them for CORS_MAX_AGE seconds.
+# Override with a comma-separated CORS_ORIGINS (e.g. for a new frontend domain);
+# a Netlify-hosted frontend (netlify.toml) must be added this way, see DEPLOYMENT.md.
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv(
+        "CORS_ORIGINS",
+        "http://localhost:3000,http://localhost:5173,https://sinatra-daw.vercel.app",
+    ).split(",")
+    if origin.strip()
+]
+CORS_MAX_AGE = 600
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "X-Session-ID"],
+    # /process-all reports the drum tempo in a header the frontend reads
+    expose_headers=["X-Detected-BPM"],
+    max_age=CORS_MAX_AGE,
 )
 
+# Compress JSON (chat replies, MIDI note lists); audio, MIDI and SSE are sent as-is
+app.add_middleware(JSONGZipMiddleware, minimum_size=512)
+
 # Mount uploads directory for direct access to generated files (crucial for persistence)
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
 app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
-# ----- In-memory state for the current session -----
-# For a hackathon demo, we just track the latest files.
-session = {
-    "drum_path": None,
-    "drum_bpm": None,
-    "vocal_path": None,
-    "midi_path": None,
-    "rendered_path": None,
-    "sample_path": None,
-    "sample_base_pitch": None,
-}
+# ----- Session state, one session per client -----
+# Clients identify themselves with an X-Session-ID header; requests without
+# one share the default session, which keeps the old single-user behaviour.
+# Sessions live in SQLite so they survive restarts and are shared by workers.
+DEFAULT_SESSION_ID = "default"
+
+
+@dataclass(frozen=True, slots=True)
+class Session:
+    """Latest files for one client. Never mutated — updates swap in a new copy."""
+    drum_path: Optional[str] = None
+    drum_bpm: Optional[float] = None
+    vocal_path: Optional[str] = None
+    midi_path: Optional[str] = None
+    rendered_path: Optional[str] = None
+    sample_path: Optional[str] = None
+    sample_base_pitch: Optional[float] = None
+
+
+_SESSION_FIELDS = frozenset(f.name for f in fields(Session))
+_session_store = SessionStore()
+# Session IDs are client-chosen, so rows of abandoned ones are swept after a while
+SESSION_TTL_SEC = float(os.getenv("SESSION_TTL_SEC", 7 * 24 * 3600))
+SESSION_SWEEP_INTERVAL_SEC = 3600
+# Only locks someone holds or waits on stay alive, so session IDs the server has
+# seen once (the header is client-chosen) don't pile up here
+_session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Session of the request being handled, set once per request by BindSessionMiddleware
+_current_session_id: ContextVar[str] = ContextVar("session_id", default=DEFAULT_SESSION_ID)
+
+
+class BindSessionMiddleware:
+    """
+    Make the caller's X-Session-ID the current session for the rest of the request.
+    Plain ASGI rather than @app.middleware("http"): BaseHTTPMiddleware re-streams
+    every response body through an in-memory pipe, which would sit between
+    FileResponse and the server (and rule out pathsend) on every audio download.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        session_id = Headers(scope=scope).get("x-session-id") or DEFAULT_SESSION_ID
+        token = _current_session_id.set(session_id)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_session_id.reset(token)
+
+
+app.add_middleware(BindSessionMiddleware)
+
+
+def _session_from(stored: dict) -> Session:
+    return Session(**{k: v for k, v in stored.items() if k in _SESSION_FIELDS})
+
+
+async def get_session() -> Session:
+    """Return a snapshot of the current client's session (empty if it has none yet)."""
+    return _session_from(await asyncio.to_thread(_session_store.load, _current_session_id.get()))
+
+
+async def update_session(**changes) -> Session:
+    """Atomically write some fields of the current client's session; returns the new snapshot."""
+    unknown = changes.keys() - _SESSION_FIELDS
+    if unknown:
+        raise TypeError(f"Unknown session fields: {sorted(unknown)}")
+    stored = await asyncio.to_thread(_session_store.save, _current_session_id.get(), changes)
+    return _session_from(stored)
+
+
+async def _expire_sessions() -> None:
+    """Every SESSION_SWEEP_INTERVAL_SEC, drop sessions nobody has written for SESSION_TTL_SEC."""
+    while True:
+        try:
+            expired = await asyncio.to_thread(_session_store.expire, SESSION_TTL_SEC)
+            if expired:
+                print(f"🧹 Expired {expired} idle session(s)")
+        except Exception as e:
+            print(f"⚠️ Session expiry failed: {e}")
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL_SEC)
+
+
+async def session_lock():
+    """
+    Dependency that serializes pipeline requests from the same client, so e.g.
+    a render can't interleave with the upload it depends on. Different clients
+    still run in parallel.
+    """
+    session_id = _current_session_id.get()
+    lock = _session_locks.get(session_id)
+    if lock is None:
+        lock = _session_locks[session_id] = asyncio.Lock()
+    async with lock:
+        yield
+
+
+def _is_wav(filename: Optional[str]) -> bool:
+    """Case-insensitive .wav extension check that only lowercases the extension."""
+    return bool(filename) and filename[-4:].lower() == ".wav"
+
+
+# ----- File responses -----
+class AudioFileResponse(FileResponse):
+    """FileResponse that streams renders in 1 MiB chunks instead of 64 KiB."""
+    chunk_size = 1 << 20
+
+
+def _file_response(path: str, media_type: str, filename: str, headers: Optional[dict] = None) -> FileResponse:
+    """Serve a file by absolute path, stat'ing it once here instead of again at send time."""
+    path = os.path.abspath(path)
+    return AudioFileResponse(
+        path,
+        media_type=media_type,
+        filename=filename,
+        headers=headers,
+        stat_result=os.stat(path),
+    )
+
+
+# Polled resources must be revalidated each time, but may be answered with a 304
+REVALIDATE_HEADERS = {"Cache-Control": "private, max-age=0, must-revalidate"}
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """True if the client's If-None-Match already names this ETag (weak comparison)."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag.removeprefix("W/")
+    return bare in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, **REVALIDATE_HEADERS})
+
+
+def _render_to_cache(
+    cache_path: str,
+    midi_path: str | bytes,
+    instrument: str,
+    sample_path: Optional[str],
+    base_pitch: Optional[float],
+    preserve_duration: bool,
+) -> str:
+    """Full-quality render for cache_path: a link to the cached one, or a fresh render stored there."""
+    wav_path = cache_fetch(cache_path)
+    if wav_path is not None:
+        print(f"♻️ Render cache hit: {os.path.basename(cache_path)}")
+        return wav_path
+    if sample_path is None:
+        wav_path = render_midi_to_wav(midi_path, instrument=instrument)
+    else:
+        wav_path = render_with_sample(
+            midi_path, sample_path, base_pitch=base_pitch, preserve_duration=preserve_duration
+        )
+    return cache_store(wav_path, cache_path)
+
+
+def _render_cached(
+    midi_path: str | bytes,
+    instrument: str,
+    sample_path: Optional[str] = None,
+    base_pitch: Optional[float] = None,
+    quality: str = "full",
+    preserve_duration: bool = False,
+) -> str:
+    """
+    Render MIDI (a path or in-memory file bytes) with a General MIDI instrument, or
+    with the custom sample when sample_path is given, reusing an earlier render of
+    identical input. quality="preview" gives the 16-bit mono downmix (~8x smaller
+    than the float original), cached beside the full render. preserve_duration
+    makes the sample keep its length across pitches (see render_with_sample).
+    The result is a fresh uploads path, never the cache entry itself, so cache
+    eviction can't pull it out from under a response or a session.
+    """
+    if sample_path is None:
+        cache_path = render_cache_path(midi_path, instrument)
+    else:
+        cache_path = render_cache_path(
+            midi_path, instrument, sample_path, repr(base_pitch), repr(preserve_duration)
+        )
+    render_args = (cache_path, midi_path, instrument, sample_path, base_pitch, preserve_duration)
+    if quality != "preview" or downmix_to_preview is None:
+        return _render_to_cache(*render_args)
+
+    preview_cache_path = cache_path.removesuffix(".wav") + ".preview.wav"
+    wav_path = cache_fetch(preview_cache_path)
+    if wav_path is None:
+        full_path = _render_to_cache(*render_args)
+        try:
+            wav_path = cache_store(downmix_to_preview(full_path), preview_cache_path)
+        finally:
+            cleanup_file(full_path)
+    return wav_path
+
+
+async def _render(midi_path: str | bytes, instrument: str, **kwargs) -> str:
+    """_render_cached on the pool; the result is tracked so old renders get deleted."""
+    wav_path = await _run_in_pool(_render_cached, midi_path, instrument, **kwargs)
+    _track_artifact(wav_path)
+    return wav_path
+
+
+@lru_cache(maxsize=32)
+def _parse_midi(midi_path: str, mtime_ns: int):
+    return pretty_midi.PrettyMIDI(midi_path)
+
+
+def _load_midi(midi_path: str, editable: bool = False):
+    """
+    Parse a MIDI file, reusing the last parse while the file is unchanged (keyed on mtime).
+    The cached object is shared, so ask for an editable copy before mutating it.
+    """
+    pm = _parse_midi(midi_path, os.stat(midi_path).st_mtime_ns)
+    return copy.deepcopy(pm) if editable else pm
+
+
+# Rendered files handed to clients (links out of the render cache, chord renders)
+# are only needed until the client has fetched them, so they are deleted in the
+# background once they are old enough -- unless some session still points at one,
+# in which case it is checked again on a later sweep.
+RENDERED_ARTIFACT_MAX_AGE_SEC = 15 * 60
+ARTIFACT_SWEEP_INTERVAL_SEC = 60
+_rendered_artifacts: deque[tuple[float, str]] = deque()  # (tracked at, path), oldest first
+
+
+def _discard(path: str) -> None:
+    """Delete a file in the background, so error responses don't wait on the unlink."""
+    asyncio.get_running_loop().run_in_executor(None, cleanup_file, path)
+
+
+def _track_artifact(wav_path: str) -> None:
+    """Remember a fresh render, for deletion once it is RENDERED_ARTIFACT_MAX_AGE_SEC old."""
+    _rendered_artifacts.append((time.monotonic(), wav_path))
+
+
+async def _expire_artifacts() -> None:
+    """Every ARTIFACT_SWEEP_INTERVAL_SEC, delete old renders that no session references."""
+    while True:
+        await asyncio.sleep(ARTIFACT_SWEEP_INTERVAL_SEC)
+        cutoff = time.monotonic() - RENDERED_ARTIFACT_MAX_AGE_SEC
+        expired = []
+        while _rendered_artifacts and _rendered_artifacts[0][0] < cutoff:
+            expired.append(_rendered_artifacts.popleft()[1])
+        if not expired:
+            continue
+        try:
+            referenced = await asyncio.to_thread(_session_store.referenced_values)
+        except Exception as e:
+            print(f"⚠️ Render cleanup skipped: {e}")
+            referenced = set(expired)
+        for path in expired:
+            if path in referenced:
+                _track_artifact(path)  # look again later
+            else:
+                _discard(path)
+
+
+# BPM, base pitch and transcriptions of recent uploads, keyed by content digest
+# (plus the settings used), so re-uploading the same file skips the analysis
+ANALYSIS_CACHE_SIZE = 64
+_analysis_cache: OrderedDict[tuple, object] = OrderedDict()
+# Second tier on disk: survives restarts and is shared by all workers
+_analysis_store = AnalysisStore()
+# Part of every analysis key. Bump it whenever detect_bpm, detect_base_pitch or
+# vocal_to_midi start producing different results, so stored ones are retired.
+ANALYSIS_VERSION = 1
+
+
+async def _analysis_get(key: tuple):
+    if key in _analysis_cache:
+        _analysis_cache.move_to_end(key)
+        return _analysis_cache[key]
+    value = await asyncio.to_thread(_analysis_store.get, repr(key))
+    if value is not None:
+        _analysis_remember(key, value)
+    return value
+
+
+def _analysis_remember(key: tuple, value) -> None:
+    _analysis_cache[key] = value
+    if len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+        _analysis_cache.popitem(last=False)
+
+
+async def _analysis_put(key: tuple, value) -> None:
+    _analysis_remember(key, value)
+    await asyncio.to_thread(_analysis_store.put, repr(key), value)
+
+
+async def _analyse_upload(digest: str, fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) on the pool, or reuse its result for an identical earlier upload."""
+    key = (ANALYSIS_VERSION, fn.__name__, digest, *sorted(kwargs.items()))
+    result = await _analysis_get(key)
+    if result is None:
+        result = await _run_in_pool(fn, *args, **kwargs)
+        await _analysis_put(key, result)
+    else:
+        print(f"♻️ Reusing {fn.__name__} result for a repeated upload")
+    return result
+
+
+# Raw Basic Pitch output of the last few /process-all vocals, keyed by content digest.
+# There inference starts before the drum's BPM (part of the transcription cache
+# key) is known, so without this a repeated upload would run it again only to
+# hit the transcription cache afterwards. Memory only: a few MB per entry.
+MODEL_OUTPUT_CACHE_SIZE = 4
+_model_output_cache: OrderedDict[str, dict] = OrderedDict()
+
+
+async def _model_output_for_upload(wav_path: str, digest: str) -> dict:
+    """run_transcription_model on the pool, or the cached output for an identical recent upload."""
+    model_output = _model_output_cache.get(digest)
+    if model_output is not None:
+        _model_output_cache.move_to_end(digest)
+        print("♻️ Reusing Basic Pitch output for a repeated upload")
+        return model_output
+    model_output = await _run_in_pool(run_transcription_model, wav_path)
+    _model_output_cache[digest] = model_output
+    if len(_model_output_cache) > MODEL_OUTPUT_CACHE_SIZE:
+        _model_output_cache.popitem(last=False)
+    return model_output
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_bytes(path: str, data: bytes) -> str:
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+async def _transcribe_upload(wav_path: str, digest: str, model_output=None, **settings) -> str:
+    """
+    vocal_to_midi for an upload. An identical earlier upload (same audio and
+    settings) has its MIDI replayed into a fresh file instead of running Basic
+    Pitch again; a copy because the piano roll edits MIDI files in place.
+    model_output (from run_transcription_model) skips inference on a cache miss.
+    """
+    key = (ANALYSIS_VERSION, "vocal_to_midi", digest, *sorted(settings.items()))
+    midi_bytes = await _analysis_get(key)
+    if midi_bytes is not None:
+        print("♻️ Reusing transcription for a repeated upload")
+        return await _run_in_pool(_write_bytes, generate_filepath("mid"), midi_bytes)
+    midi_path = await _run_in_pool(vocal_to_midi, wav_path, model_output=model_output, **settings)
+    await _analysis_put(key, await _run_in_pool(_read_bytes, midi_path))
+    return midi_path
 
 
 # ==================== ENDPOINTS ====================
 
 
-@app.post("/upload-drum")
-async def upload_drum(file: UploadFile = File(...)):
+@app.post("/upload-drum", dependencies=[Depends(session_lock)])
+async def upload_drum(
+    file: UploadFile = File(...),
+):
     """
     Upload a drum loop WAV.
     Detects BPM and returns it.
     """
-    if not file.filename.lower().endswith(".wav"):
+    if not _is_wav(file.filename):
         raise HTTPException(status_code=400, detail="Only WAV files are accepted.")
 
-    file_path = await save_upload(file)
+    file_path, digest = await save_upload_hashed(file)
 
     if not validate_wav(file_path):
-        cleanup_file(file_path)
+        _discard(file_path)
         raise HTTPException(status_code=400, detail="Invalid WAV file.")
 
     if detect_bpm is None:
-        cleanup_file(file_path)
+        _discard(file_path)
         raise HTTPException(status_code=500, detail="BPM detection service not available")
     
     try:
-        bpm = detect_bpm(file_path)
+        bpm = await _analyse_upload(digest, detect_bpm, file_path)
     except Exception as e:
-        cleanup_file(file_path)
+        _discard(file_path)
         raise HTTPException(status_code=500, detail=f"BPM detection failed: {e}")
 
     # Store in session
-    session["drum_path"] = file_path
-    session["drum_bpm"] = bpm
+    await update_session(drum_path=file_path, drum_bpm=bpm)
 
     return {"status": "ok", "bpm": bpm, "filename": os.path.basename(file_path)}
 
 
-@app.post("/upload-sample")
-async def upload_sample(file: UploadFile = File(...)):
+@app.post("/upload-sample", dependencies=[Depends(session_lock)])
+async def upload_sample(
+    file: UploadFile = File(...),
+):
     """
     Upload a one-shot audio sample (WAV).
     Detects the sample's base pitch and stores it for use as a custom instrument.
     """
-    if not file.filename.lower().endswith(".wav"):
+    if not _is_wav(file.filename):
         raise HTTPException(status_code=400, detail="Only WAV files are accepted.")
 
-    file_path = await save_upload(file)
+    file_path, digest = await save_upload_hashed(file)
 
     if not validate_wav(file_path):
-        cleanup_file(file_path)
+        _discard(file_path)
         raise HTTPException(status_code=400, detail="Invalid WAV file.")
 
+    if detect_base_pitch is None:
+        _discard(file_path)
+        raise HTTPException(status_code=500, detail="Pitch detection service not available")
+
     try:
-        base_pitch = detect_base_pitch(file_path)
+        base_pitch = await _analyse_upload(digest, detect_base_pitch, file_path)
     except Exception as e:
-        cleanup_file(file_path)
+        _discard(file_path)
         raise HTTPException(status_code=500, detail=f"Pitch detection failed: {e}")
 
-    session["sample_path"] = file_path
-    session["sample_base_pitch"] = base_pitch
+    if base_pitch is None or not np.isfinite(base_pitch):
+        _discard(file_path)
+        raise HTTPException(
+            status_code=400,
+            detail="Could not detect the sample's pitch. Upload an audible, pitched one-shot.",
+        )
+
+    await update_session(sample_path=file_path, sample_base_pitch=base_pitch)
 
-    import librosa as _lr
-    note_name = _lr.midi_to_note(round(base_pitch))
+    note_name = midi_to_note(round(base_pitch))
 
     return {
         "status": "ok",
@@ -199,7 +720,7 @@ async def upload_sample(file: UploadFile = File(...)):
     }
 
 
-@app.post("/upload-vocal")
+@app.post("/upload-vocal", dependencies=[Depends(session_lock)])
 async def upload_vocal(
     file: UploadFile = File(...),
     raw_audio: bool = Form(default=False),
@@ -212,21 +733,18 @@ async def upload_vocal(
     If raw_audio=True, just stores the file (no MIDI conversion).
     Otherwise, converts it to MIDI with optional key/scale snapping and quantization.
     """
-    if not file.filename.lower().endswith(".wav"):
+    if not _is_wav(file.filename):
         raise HTTPException(status_code=400, detail="Only WAV files are accepted.")
 
-    file_path = await save_upload(file)
+    file_path, digest = await save_upload_hashed(file)
 
     if not validate_wav(file_path):
-        cleanup_file(file_path)
+        _discard(file_path)
         raise HTTPException(status_code=400, detail="Invalid WAV file.")
 
-    # Store in session
-    session["vocal_path"] = file_path
-
     if raw_audio:
         # Raw audio mode: just store the file, no MIDI conversion
-        session["midi_path"] = None
+        await update_session(vocal_path=file_path, midi_path=None)
         return {
             "status": "ok",
             "midi_filename": None,
@@ -235,22 +753,23 @@ async def upload_vocal(
     else:
         # Convert to MIDI with key/scale/quantize
         if vocal_to_midi is None:
-            cleanup_file(file_path)
+            _discard(file_path)
             raise HTTPException(status_code=503, detail="Transcription service not available. basic-pitch failed to load on this server.")
         try:
-            current_bpm = session.get("drum_bpm") or 120
-            midi_path = vocal_to_midi(
+            current_bpm = (await get_session()).drum_bpm or 120
+            midi_path = await _transcribe_upload(
                 file_path,
+                digest,
                 bpm=current_bpm,
                 key=key,
                 scale=scale,
                 quantize=quantize,
             )
         except Exception as e:
-            cleanup_file(file_path)
+            _discard(file_path)
             raise HTTPException(status_code=500, detail=f"MIDI transcription failed: {e}")
 
-        session["midi_path"] = midi_path
+        await update_session(vocal_path=file_path, midi_path=midi_path)
         return {
             "status": "ok",
             "midi_filename": os.path.basename(midi_path),
@@ -258,32 +777,44 @@ async def upload_vocal(
         }
 
 
-@app.post("/render")
-async def render(instrument: str = Form(default="Piano")):
+@app.post("/render", dependencies=[Depends(session_lock)])
+async def render(
+    instrument: str = Form(default="Piano"),
+    preserve_duration: bool = Form(default=False),
+    quality: Literal["full", "preview"] = Query(default="full"),
+):
     """
     Render the most recent MIDI file to a WAV using FluidSynth.
     If raw_audio mode was used, just returns the original WAV file.
-    Returns the WAV file for playback.
+    Returns the WAV file for playback (16-bit mono 22.05 kHz with ?quality=preview).
     """
     # Check if we're in raw audio mode (no MIDI conversion)
-    vocal_path = session.get("vocal_path")
-    midi_path = session.get("midi_path")
-    
-    if midi_path is None and vocal_path and os.path.exists(vocal_path):
+    state = await get_session()
+    vocal_path = state.vocal_path
+    midi_path = state.midi_path
+
+    no_midi = HTTPException(
+        status_code=400,
+        detail="No MIDI file available. Upload a vocal first.",
+    )
+
+    if midi_path is None and vocal_path:
         # Raw audio mode: return the original file
-        session["rendered_path"] = vocal_path
-        return FileResponse(
-            vocal_path,
-            media_type="audio/wav",
-            filename="sinatra_raw_audio.wav",
-        )
+        try:
+            response = _file_response(
+                vocal_path,
+                media_type="audio/wav",
+                filename="sinatra_raw_audio.wav",
+            )
+        except FileNotFoundError:
+            raise no_midi
+        await update_session(rendered_path=vocal_path)
+        return response
     
-    # MIDI mode: render MIDI to WAV
-    if not midi_path or not os.path.exists(midi_path):
-        raise HTTPException(
-            status_code=400,
-            detail="No MIDI file available. Upload a vocal first.",
-        )
+    # MIDI mode: render MIDI to WAV. Missing files surface as FileNotFoundError
+    # from the renderer rather than being stat'ed up front.
+    if not midi_path:
+        raise no_midi
 
     try:
         if render_midi_to_wav is None:
@@ -291,34 +822,46 @@ async def render(instrument: str = Form(default="Piano")):
         
         if instrument == "Custom Sample":
             # Use the uploaded one-shot sample as the instrument
-            sample_path = session.get("sample_path")
-            if not sample_path or not os.path.exists(sample_path):
+            sample_path = state.sample_path
+            if not sample_path:
                 raise HTTPException(
                     status_code=400,
                     detail="No sample uploaded. Upload a one-shot sample first.",
                 )
-            wav_path = render_with_sample(
+            wav_path = await _render(
                 midi_path,
-                sample_path,
-                base_pitch=session.get("sample_base_pitch"),
+                instrument,
+                sample_path=sample_path,
+                base_pitch=state.sample_base_pitch,
+                preserve_duration=preserve_duration,
+                quality=quality,
             )
         else:
-            wav_path = render_midi_to_wav(midi_path, instrument=instrument)
+            wav_path = await _render(midi_path, instrument, quality=quality)
+    except HTTPException:
+        raise
     except FileNotFoundError as e:
+        if e.filename == midi_path:
+            raise no_midi
+        if e.filename is not None and e.filename == state.sample_path:
+            raise HTTPException(
+                status_code=400,
+                detail="No sample uploaded. Upload a one-shot sample first.",
+            )
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Rendering failed: {e}")
 
-    session["rendered_path"] = wav_path
+    await update_session(rendered_path=wav_path)
 
-    return FileResponse(
+    return _file_response(
         wav_path,
         media_type="audio/wav",
         filename="sinatra_output.wav",
     )
 
 
-@app.post("/process-all")
+@app.post("/process-all", dependencies=[Depends(session_lock)])
 async def process_all(
     vocal: UploadFile = File(...),
     drum: UploadFile = File(None),
@@ -331,62 +874,89 @@ async def process_all(
     3. Render MIDI → WAV with chosen instrument
     4. Return the rendered WAV
     """
-    bpm = None
+    if drum is not None and not _is_wav(drum.filename):
+        raise HTTPException(status_code=400, detail="Drum file must be WAV.")
+    if not _is_wav(vocal.filename):
+        raise HTTPException(status_code=400, detail="Vocal file must be WAV.")
 
-    # --- Step 1: Drum BPM (optional) ---
-    if drum is not None:
-        if not drum.filename.lower().endswith(".wav"):
-            raise HTTPException(status_code=400, detail="Drum file must be WAV.")
-        drum_path = await save_upload(drum)
+    async def _drum_stage() -> tuple[str, float]:
+        drum_path, drum_digest = await save_upload_hashed(drum)
         if not validate_wav(drum_path):
-            cleanup_file(drum_path)
+            _discard(drum_path)
             raise HTTPException(status_code=400, detail="Invalid drum WAV file.")
         try:
-            bpm = detect_bpm(drum_path)
+            bpm = await _analyse_upload(drum_digest, detect_bpm, drum_path)
         except Exception as e:
-            cleanup_file(drum_path)
+            _discard(drum_path)
             raise HTTPException(status_code=500, detail=f"BPM detection failed: {e}")
-        session["drum_path"] = drum_path
-        session["drum_bpm"] = bpm
-
-    # --- Step 2: Vocal → MIDI ---
-    if not vocal.filename.lower().endswith(".wav"):
-        raise HTTPException(status_code=400, detail="Vocal file must be WAV.")
-    vocal_path = await save_upload(vocal)
-    if not validate_wav(vocal_path):
-        cleanup_file(vocal_path)
-        raise HTTPException(status_code=400, detail="Invalid vocal WAV file.")
+        return drum_path, bpm
 
     if vocal_to_midi is None:
-        cleanup_file(vocal_path)
         raise HTTPException(status_code=500, detail="Transcription service not available")
-    
+
+    async def _vocal_stage() -> tuple[str, str, Optional[dict]]:
+        vocal_path, vocal_digest = await save_upload_hashed(vocal)
+        if not validate_wav(vocal_path):
+            _discard(vocal_path)
+            raise HTTPException(status_code=400, detail="Invalid vocal WAV file.")
+        if drum is None:
+            return vocal_path, vocal_digest, None
+        # Basic Pitch inference doesn't depend on tempo, so run it while the
+        # drum's BPM is detected; only note creation has to wait for the BPM
+        try:
+            model_output = await _model_output_for_upload(vocal_path, vocal_digest)
+        except Exception as e:
+            _discard(vocal_path)
+            raise HTTPException(status_code=500, detail=f"MIDI transcription failed: {e}")
+        return vocal_path, vocal_digest, model_output
+
+    # --- Steps 1-2: Drum BPM (optional), overlapped with saving + analysing the vocal ---
+    drum_result, vocal_result = await asyncio.gather(
+        _drum_stage() if drum is not None else asyncio.sleep(0),
+        _vocal_stage(),
+        return_exceptions=True,
+    )
+    if isinstance(drum_result, BaseException) or isinstance(vocal_result, BaseException):
+        if isinstance(vocal_result, tuple):
+            _discard(vocal_result[0])
+        if isinstance(drum_result, tuple):
+            _discard(drum_result[0])
+        raise drum_result if isinstance(drum_result, BaseException) else vocal_result
+    vocal_path, vocal_digest, model_output = vocal_result
+
+    bpm = None
+    if drum_result is not None:
+        drum_path, bpm = drum_result
+        await update_session(drum_path=drum_path, drum_bpm=bpm)
+
+    # --- Step 2: Vocal → MIDI ---
     try:
-        current_bpm = bpm or session.get("drum_bpm") or 120
-        midi_path = vocal_to_midi(vocal_path, bpm=current_bpm)
+        current_bpm = bpm or (await get_session()).drum_bpm or 120
+        midi_path = await _transcribe_upload(
+            vocal_path, vocal_digest, model_output=model_output, bpm=current_bpm
+        )
     except Exception as e:
-        cleanup_file(vocal_path)
+        _discard(vocal_path)
         raise HTTPException(status_code=500, detail=f"MIDI transcription failed: {e}")
 
-    session["vocal_path"] = vocal_path
-    session["midi_path"] = midi_path
+    await update_session(vocal_path=vocal_path, midi_path=midi_path)
 
     # --- Step 3: Render MIDI → WAV ---
     try:
-        wav_path = render_midi_to_wav(midi_path, instrument=instrument)
+        wav_path = await _render(midi_path, instrument)
     except FileNotFoundError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Rendering failed: {e}")
 
-    session["rendered_path"] = wav_path
+    await update_session(rendered_path=wav_path)
 
     # Build response headers with BPM info if available
     headers = {}
     if bpm is not None:
         headers["X-Detected-BPM"] = str(bpm)
 
-    return FileResponse(
+    return _file_response(
         wav_path,
         media_type="audio/wav",
         filename="sinatra_output.wav",
@@ -396,10 +966,11 @@ async def process_all(
 
 @app.get("/health")
 async def health():
-    """Simple health check."""
+    """Simple health check; "ready" turns true once startup warm-up has finished."""
     return {
         "status": "ok",
-        "session": {k: v is not None for k, v in session.items()},
+        "ready": _warmed_up,
+        "session": {k: v is not None for k, v in asdict(await get_session()).items()},
         "services": {
             "bpm": detect_bpm is not None,
             "transcription": vocal_to_midi is not None,
@@ -411,22 +982,31 @@ async def health():
 
 
 @app.get("/download-midi")
-async def download_midi():
-    """Download the latest generated MIDI file."""
-    midi_path = session.get("midi_path")
-    if not midi_path or not os.path.exists(midi_path):
+async def download_midi(http_request: Request):
+    """Download the latest generated MIDI file (304 if the client's copy is current)."""
+    midi_path = (await get_session()).midi_path
+    if not midi_path:
         raise HTTPException(status_code=404, detail="No MIDI file available.")
-    return FileResponse(
-        midi_path,
-        media_type="audio/midi",
-        filename="sinatra_vocal.mid",
-    )
+    try:
+        response = _file_response(
+            midi_path,
+            media_type="audio/midi",
+            filename="sinatra_vocal.mid",
+            headers=REVALIDATE_HEADERS,
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="No MIDI file available.")
+    # FileResponse derives its ETag from size + mtime
+    if _etag_matches(http_request, response.headers["etag"]):
+        return _not_modified(response.headers["etag"])
+    return response
 
 
-@app.post("/re-render")
+@app.post("/re-render", dependencies=[Depends(session_lock)])
 async def re_render(
     midi_filename: str = Form(...),
     instrument: str = Form(default="Piano"),
+    preserve_duration: bool = Form(default=False),
 ):
     """
     Re-render a specific MIDI file with a different instrument.
@@ -441,54 +1021,63 @@ async def re_render(
 
     try:
         if instrument == "Custom Sample":
-            sample_path = session.get("sample_path")
+            state = await get_session()
+            sample_path = state.sample_path
             if not sample_path or not os.path.exists(sample_path):
                 raise HTTPException(
                     status_code=400,
                     detail="No sample uploaded. Upload a one-shot sample first.",
                 )
-            wav_path = render_with_sample(
+            wav_path = await _render(
                 midi_path,
-                sample_path,
-                base_pitch=session.get("sample_base_pitch"),
+                instrument,
+                sample_path=sample_path,
+                base_pitch=state.sample_base_pitch,
+                preserve_duration=preserve_duration,
             )
         else:
-            wav_path = render_midi_to_wav(midi_path, instrument=instrument)
+            wav_path = await _render(midi_path, instrument)
     except FileNotFoundError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Re-rendering failed: {e}")
 
-    return FileResponse(
+    return _file_response(
         wav_path,
         media_type="audio/wav",
         filename="sinatra_rerendered.wav",
     )
 
 @app.get("/midi-notes")
-async def get_midi_notes(filename: str):
+async def get_midi_notes(filename: str, http_request: Request):
     """
     Get the list of notes from a MIDI file.
     Returns: { "notes": [ { pitch, start, end, velocity }, ... ] }
+    Answers 304 when the client's ETag still matches the file.
     """
     midi_path = os.path.join(UPLOAD_DIR, filename)
-    if not os.path.exists(midi_path):
+    try:
+        st = os.stat(midi_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="MIDI file not found.")
 
+    # Editor polls are cheap while the file is unchanged; edits rewrite it and move the ETag
+    etag = f'W/"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    if _etag_matches(http_request, etag):
+        return _not_modified(etag)
+
     try:
-        import pretty_midi
-        pm = pretty_midi.PrettyMIDI(midi_path)
+        pm = await _run_in_pool(_load_midi, midi_path)
         notes = []
         # We assume the first instrument is the one we want to edit
         if len(pm.instruments) > 0:
-            for note in pm.instruments[0].notes:
-                notes.append({
-                    "pitch": note.pitch,
-                    "start": note.start,
-                    "end": note.end,
-                    "velocity": note.velocity
-                })
-        return {"notes": notes}
+            notes = [
+                {"pitch": note.pitch, "start": note.start, "end": note.end, "velocity": note.velocity}
+                for note in pm.instruments[0].notes
+            ]
+        # Already plain JSON types: hand them straight to orjson and skip
+        # FastAPI's jsonable_encoder walk over thousands of note dicts
+        return ORJSONResponse({"notes": notes}, headers={"ETag": etag, **REVALIDATE_HEADERS})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to read MIDI: {e}")
 
@@ -504,7 +1093,6 @@ async def create_empty_midi(request: CreateMidiRequest):
     Create a new empty MIDI file.
     """
     try:
-        import pretty_midi
         pm = pretty_midi.PrettyMIDI(initial_tempo=request.bpm)
         # Create an empty instrument track
         inst = pretty_midi.Instrument(program=0) # Piano
@@ -529,32 +1117,56 @@ async def hydrate_midi(request: HydrateMidiRequest):
     Download a MIDI file from a remote URL to the local uploads directory.
     Required for the backend to process files that are stored outside the backend runtime.
     """
-    import requests
-    
     try:
-        # Check if file already exists
         file_path = os.path.join(UPLOAD_DIR, request.filename)
-        
-        # Download the file
-        response = requests.get(request.url)
-        response.raise_for_status()
-        
-        with open(file_path, "wb") as f:
-            f.write(response.content)
-            
+        # Download under a scratch name and rename when complete, so a failed or
+        # cancelled transfer never leaves a truncated MIDI at file_path
+        part_path = file_path + ".part"
+
+        # Stream the download straight to disk without blocking the event loop
+        try:
+            async with HTTP_CLIENT.stream("GET", request.url) as response:
+                response.raise_for_status()
+                async with aiofiles.open(part_path, "wb") as f:
+                    async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        await f.write(chunk)
+            os.replace(part_path, file_path)
+        except BaseException:
+            _discard(part_path)
+            raise
+
         return {"status": "ok", "filename": request.filename}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to hydrate MIDI: {e}")
 
 
+def _notes_from_payload(notes: list[dict]) -> list:
+    """
+    Turn the editor's { pitch, start, end, velocity } dicts into pretty_midi Notes.
+    All fields are converted in one NumPy pass instead of four int()/float() calls per note.
+    """
+    if not notes:
+        return []
+    table = np.array([(n["pitch"], n["start"], n["end"], n["velocity"]) for n in notes], dtype=np.float64)
+    pitches = table[:, 0].astype(np.int64).tolist()
+    velocities = table[:, 3].astype(np.int64).tolist()
+    return [
+        pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end)
+        for pitch, start, end, velocity in zip(pitches, table[:, 1].tolist(), table[:, 2].tolist(), velocities)
+    ]
+
+
 class UpdateNotesRequest(BaseModel):
     midi_filename: str
     notes: list[dict] # { pitch, start, end, velocity }
     instrument: str = "Piano"
+    preserve_duration: bool = False  # Custom Sample only: keep the sample's length at every pitch
 
 
-@app.post("/update-midi-notes")
-async def update_midi_notes(request: UpdateNotesRequest):
+@app.post("/update-midi-notes", dependencies=[Depends(session_lock)])
+async def update_midi_notes(
+    request: UpdateNotesRequest,
+):
     """
     Update notes in a MIDI file and re-render the audio.
     Returns the new WAV file.
@@ -564,54 +1176,43 @@ async def update_midi_notes(request: UpdateNotesRequest):
         raise HTTPException(status_code=404, detail="MIDI file not found.")
 
     try:
-        import pretty_midi
-        pm = pretty_midi.PrettyMIDI(midi_path)
+        pm = await _run_in_pool(_load_midi, midi_path, editable=True)
         
         # Replace notes in the first instrument
         if len(pm.instruments) > 0:
              # Keep the existing instrument program (sound)
             inst = pm.instruments[0]
-            inst.notes = []
-            for n in request.notes:
-                inst.notes.append(pretty_midi.Note(
-                    velocity=int(n["velocity"]),
-                    pitch=int(n["pitch"]),
-                    start=float(n["start"]),
-                    end=float(n["end"])
-                ))
+            inst.notes = _notes_from_payload(request.notes)
         else:
             # Create a new instrument if none exists
             program = INSTRUMENT_PROGRAMS.get(request.instrument, 0)
             inst = pretty_midi.Instrument(program=program)
-            for n in request.notes:
-                inst.notes.append(pretty_midi.Note(
-                    velocity=int(n["velocity"]),
-                    pitch=int(n["pitch"]),
-                    start=float(n["start"]),
-                    end=float(n["end"])
-                ))
+            inst.notes = _notes_from_payload(request.notes)
             pm.instruments.append(inst)
 
         # Save unmodified MIDI
-        pm.write(midi_path)
+        await _run_in_pool(pm.write, midi_path)
 
         # Render to WAV
         if request.instrument == "Custom Sample":
-            sample_path = session.get("sample_path")
+            state = await get_session()
+            sample_path = state.sample_path
             if not sample_path or not os.path.exists(sample_path):
                 raise HTTPException(
                     status_code=400,
                     detail="No sample uploaded. Upload a one-shot sample first.",
                 )
-            wav_path = render_with_sample(
+            wav_path = await _render(
                 midi_path,
-                sample_path,
-                base_pitch=session.get("sample_base_pitch"),
+                request.instrument,
+                sample_path=sample_path,
+                base_pitch=state.sample_base_pitch,
+                preserve_duration=request.preserve_duration,
             )
         else:
-            wav_path = render_midi_to_wav(midi_path, instrument=request.instrument)
+            wav_path = await _render(midi_path, request.instrument)
 
-        return FileResponse(
+        return _file_response(
             wav_path,
             media_type="audio/wav",
             filename="sinatra_updated.wav",
@@ -624,17 +1225,20 @@ async def update_midi_notes(request: UpdateNotesRequest):
 class PreviewNotesRequest(BaseModel):
     notes: list[dict] # { pitch, start, end, velocity }
     instrument: str = "Piano"
+    preserve_duration: bool = False  # Custom Sample only: keep the sample's length at every pitch
 
 
-@app.post("/preview-midi-notes")
-async def preview_midi_notes(request: PreviewNotesRequest):
+@app.post("/preview-midi-notes", dependencies=[Depends(session_lock)])
+async def preview_midi_notes(
+    request: PreviewNotesRequest,
+    quality: Literal["full", "preview"] = Query(default="full"),
+):
     """
     Generate a temporary audio preview for a set of notes.
     Does NOT overwrite the original MIDI file.
-    Returns: WAV audio blob.
+    Returns: WAV audio blob (16-bit mono 22.05 kHz with ?quality=preview).
     """
     try:
-        import pretty_midi
         
         # Create a new MIDI object (120 BPM default, will be overridden by duration if needed)
         pm = pretty_midi.PrettyMIDI(initial_tempo=120) 
@@ -643,50 +1247,42 @@ async def preview_midi_notes(request: PreviewNotesRequest):
         program = INSTRUMENT_PROGRAMS.get(request.instrument, 0)
         inst = pretty_midi.Instrument(program=program)
         
-        for n in request.notes:
-            inst.notes.append(pretty_midi.Note(
-                velocity=int(n["velocity"]),
-                pitch=int(n["pitch"]),
-                start=float(n["start"]),
-                end=float(n["end"])
-            ))
+        inst.notes = _notes_from_payload(request.notes)
         pm.instruments.append(inst)
 
-        # Write to temp file
-        import time
-        temp_filename = f"preview_{int(time.time()*1000)}.mid"
-        temp_midi_path = os.path.join(UPLOAD_DIR, temp_filename)
-        pm.write(temp_midi_path)
-        
+        # Serialize in memory: the renderers and the render cache take the bytes
+        # directly, so a preview never touches disk until the cached WAV
+        buf = io.BytesIO()
+        pm.write(buf)
+        midi_bytes = buf.getvalue()
+
         # Render to WAV
         if request.instrument == "Custom Sample":
-            sample_path = session.get("sample_path")
+            state = await get_session()
+            sample_path = state.sample_path
             if not sample_path or not os.path.exists(sample_path):
-                 # Fail gracefully? Or error? Let's error.
-                 cleanup_file(temp_midi_path)
-                 raise HTTPException(status_code=400, detail="No custom sample loaded.")
-            
-            wav_path = render_with_sample(
-                temp_midi_path,
-                sample_path,
-                base_pitch=session.get("sample_base_pitch")
+                raise HTTPException(status_code=400, detail="No custom sample loaded.")
+
+            wav_path = await _render(
+                midi_bytes,
+                request.instrument,
+                sample_path=sample_path,
+                base_pitch=state.sample_base_pitch,
+                preserve_duration=request.preserve_duration,
+                quality=quality,
             )
         else:
-            wav_path = render_midi_to_wav(temp_midi_path, instrument=request.instrument)
-        
-        # We need to read the file and return it, then delete it.
-        # fastAPI FileResponse streams it, so we can't delete immediately after returning.
-        
-        with open(wav_path, "rb") as f:
-            wav_data = f.read()
-            
-        # Cleanup temp files
-        cleanup_file(temp_midi_path)
-        cleanup_file(wav_path)
-        
-        from fastapi import Response
-        return Response(content=wav_data, media_type="audio/wav")
+            wav_path = await _render(midi_bytes, request.instrument, quality=quality)
+
+        # Stream the cached render from disk instead of buffering it into a Response
+        return _file_response(
+            wav_path,
+            media_type="audio/wav",
+            filename="sinatra_preview.wav",
+        )
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Preview failed: {e}")
 
@@ -694,6 +1290,9 @@ async def preview_midi_notes(request: PreviewNotesRequest):
 
 
 class ChordRequest(BaseModel):
+    # Read-only request body: drop unknown keys, no assignment validation
+    model_config = ConfigDict(extra="ignore", validate_assignment=False, frozen=True)
+
     chords: List[str] = Field(default_factory=list)
     bpm: float = 120.0
     beats_per_chord: int = 4
@@ -721,7 +1320,8 @@ async def generate_chords_endpoint(request: ChordRequest):
         raise HTTPException(status_code=400, detail="Maximum 64 chords per progression.")
 
     try:
-        wav_path = generate_chord_progression(
+        wav_path = await _run_in_pool(
+            generate_chord_progression,
             chords=request.chords,
             bpm=request.bpm,
             beats_per_chord=request.beats_per_chord,
@@ -730,7 +1330,8 @@ async def generate_chords_endpoint(request: ChordRequest):
             velocity=request.velocity,
             pattern=request.pattern,
         )
-        return FileResponse(
+        _track_artifact(wav_path)
+        return _file_response(
             wav_path,
             media_type="audio/wav",
             filename="sinatra_chords.wav",
@@ -742,12 +1343,14 @@ async def generate_chords_endpoint(request: ChordRequest):
 # ==================== CHAT ENDPOINTS ====================
 
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", validate_assignment=False, frozen=True)
+
     message: str
     context: Optional[dict] = None
 
 
 @app.post("/chat")
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, http_request: Request):
     """
     Send a text message to Frank (AI assistant).
     Includes project context for relevant suggestions.
@@ -756,12 +1359,47 @@ async def chat_endpoint(request: ChatRequest):
     if not request.message.strip():
         raise HTTPException(status_code=400, detail="Message cannot be empty.")
     
-    result = gemini_chat(request.message, request.context)
-    return result
+    task = asyncio.ensure_future(
+        gemini_chat(request.message, request.context, session_id=_current_session_id.get())
+    )
+    # Abort the Gemini request as soon as the client goes away
+    while not task.done():
+        if await http_request.is_disconnected():
+            task.cancel()
+            raise HTTPException(status_code=499, detail="Client disconnected.")
+        await asyncio.wait({task}, timeout=0.05)
+    return task.result()
+
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Like /chat, but streamed as Server-Sent Events so text shows up as it is generated.
+    "delta" events carry raw text chunks; the final "done" event carries the
+    cleaned response and actions, in the same shape /chat returns.
+    """
+    if not request.message.strip():
+        raise HTTPException(status_code=400, detail="Message cannot be empty.")
+
+    async def events():
+        async for event, data in gemini_chat_stream(
+            request.message, request.context, session_id=_current_session_id.get()
+        ):
+            yield f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+    # Starlette stops the generator (and the Gemini stream) if the client disconnects
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
 
 
 @app.post("/chat/clear")
 async def chat_clear_endpoint():
-    """Clear the chat conversation history."""
-    clear_chat_history()
+    """Clear this session's chat conversation history."""
+    clear_chat_history(_current_session_id.get())
     return {"status": "ok", "message": "Chat history cleared."}
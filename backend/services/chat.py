@@ -5,8 +5,11 @@ Handles conversation with project context and action parsing.
 
 import os
 import re
-import json
+import orjson
+import threading
 import httpx
+from collections import OrderedDict, deque
+from functools import lru_cache
 from typing import Optional
 
 # --- Configuration ---
@@ -82,8 +85,57 @@ IMPORTANT for chord progressions:
 
 Always be helpful, concise, and musically knowledgeable. If the user provides project context (tracks, BPM, etc.), use it to give relevant suggestions."""
 
-# --- In-memory conversation history ---
-conversation_history: list[dict] = []
+# --- In-memory conversation history, one per session ---
+HISTORY_MAX_MESSAGES = 40   # last 20 exchanges
+HISTORY_MAX_CHARS = 8000    # ~2k tokens (chars/4) of history re-sent with each message
+MAX_SESSIONS = 256          # least recently active conversations are dropped beyond this
+
+_histories: OrderedDict[str, deque] = OrderedDict()
+_histories_lock = threading.Lock()
+
+
+def _history(session_id: str) -> deque:
+    """Return (creating if needed) the conversation for a session, marking it active."""
+    with _histories_lock:
+        history = _histories.get(session_id)
+        if history is None:
+            history = _histories[session_id] = deque(maxlen=HISTORY_MAX_MESSAGES)
+            if len(_histories) > MAX_SESSIONS:
+                _histories.popitem(last=False)
+        else:
+            _histories.move_to_end(session_id)
+        return history
+
+
+def _trim_history(history: deque) -> None:
+    """Drop the oldest messages until the history fits HISTORY_MAX_CHARS, keeping the newest."""
+    total = sum(len(item["content"]) for item in history)
+    while len(history) > 1 and total > HISTORY_MAX_CHARS:
+        total -= len(history.popleft()["content"])
+    # Gemini expects the conversation to open with a user turn
+    while len(history) > 1 and history[0]["role"] != "user":
+        history.popleft()
+
+
+# HTTP/2 lets concurrent chats share one connection (needs httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+@lru_cache(maxsize=1)
+def _gemini_client() -> httpx.AsyncClient:
+    """Shared HTTP client so the TCP/TLS connection to Gemini is reused across messages."""
+    return httpx.AsyncClient(timeout=30.0, http2=HTTP2_AVAILABLE)
+
+
+async def close_client() -> None:
+    """Close the shared Gemini client, if one was created (called at app shutdown)."""
+    if _gemini_client.cache_info().currsize:
+        await _gemini_client().aclose()
+        _gemini_client.cache_clear()
 
 
 def _normalize_gemini_model(model_name: str) -> str:
@@ -135,18 +187,22 @@ def _build_context_message(context: Optional[dict]) -> str:
     return "\n".join(parts)
 
 
+# ```action ... ``` blocks in model replies; compiled once for every response
+_ACTION_RE = re.compile(r'```action\s*\n?(.*?)\n?\s*```', re.DOTALL)
+_MULTI_NEWLINE_RE = re.compile(r'\n{3,}')
+
+
 def parse_actions(response_text: str) -> list[dict]:
     """Extract action blocks from the response text."""
     actions = []
-    pattern = r'```action\s*\n?(.*?)\n?\s*```'
-    matches = re.findall(pattern, response_text, re.DOTALL)
+    matches = _ACTION_RE.findall(response_text)
     
     for match in matches:
         try:
-            action = json.loads(match.strip())
+            action = orjson.loads(match.strip())
             if "type" in action:
                 actions.append(action)
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             continue
     
     return actions
@@ -154,94 +210,110 @@ def parse_actions(response_text: str) -> list[dict]:
 
 def strip_action_blocks(response_text: str) -> str:
     """Remove action blocks from the response text for display."""
-    pattern = r'```action\s*\n?.*?\n?\s*```'
-    cleaned = re.sub(pattern, '', response_text, flags=re.DOTALL)
-    cleaned = re.sub(r'\n{3,}', '\n\n', cleaned)
+    cleaned = _ACTION_RE.sub('', response_text)
+    cleaned = _MULTI_NEWLINE_RE.sub('\n\n', cleaned)
     return cleaned.strip()
 
 
-def chat(message: str, context: Optional[dict] = None) -> dict:
-    """
-    Send a message to Gemini and get a response.
-    Returns { "response": str, "actions": list[dict] }
-    """
-    if not GEMINI_API_KEY:
-        return {
-            "response": "Chat is unavailable: GEMINI_API_KEY environment variable is not set.",
-            "actions": [],
-        }
-    
+CHAT_UNAVAILABLE = {
+    "response": "Chat is unavailable: GEMINI_API_KEY environment variable is not set.",
+    "actions": [],
+}
+
+
+def _start_turn(message: str, context: Optional[dict], session_id: str) -> tuple[deque, dict]:
+    """Record the user's message in the session history and build the Gemini request body."""
     # Build the user message with context
     full_message = message
     context_str = _build_context_message(context)
     if context_str:
         full_message = f"{message}\n{context_str}"
-    
-    # Add to conversation history
+
+    # Add to conversation history, bounded by message count and by size
+    conversation_history = _history(session_id)
     conversation_history.append({
         "role": "user",
         "content": full_message,
     })
-    
-    # Keep history manageable (last 20 exchanges)
-    if len(conversation_history) > 40:
-        conversation_history[:] = conversation_history[-40:]
-    
+    _trim_history(conversation_history)
+
+    contents = [
+        {
+            "role": "user" if item["role"] == "user" else "model",
+            "parts": [{"text": item["content"]}],
+        }
+        for item in conversation_history
+    ]
+    payload = {
+        "system_instruction": {
+            "parts": [{"text": SYSTEM_PROMPT}],
+        },
+        "contents": contents,
+        "generationConfig": {
+            "temperature": 0.7,
+            "maxOutputTokens": 1024,
+        },
+    }
+    return conversation_history, payload
+
+
+def _finish_turn(conversation_history: deque, response_text: str) -> dict:
+    """Record the assistant's reply and split it into display text and actions."""
+    response_text = response_text.strip() or "I couldn't generate a response."
+
+    # Add assistant response to history
+    conversation_history.append({
+        "role": "assistant",
+        "content": response_text,
+    })
+
+    # Parse actions from response
+    return {
+        "response": strip_action_blocks(response_text),
+        "actions": parse_actions(response_text),
+    }
+
+
+def _error_message(response: httpx.Response) -> str:
+    try:
+        error_data = response.json()
+    except ValueError:
+        error_data = {}
+    return error_data.get("error", {}).get("message", f"HTTP {response.status_code}")
+
+
+def _candidate_text(data: dict) -> str:
+    return "".join(
+        part.get("text", "")
+        for part in data.get("candidates", [{}])[0]
+        .get("content", {})
+        .get("parts", [])
+    )
+
+
+async def chat(message: str, context: Optional[dict] = None, session_id: str = "default") -> dict:
+    """
+    Send a message to Gemini and get a response, continuing this session's conversation.
+    Returns { "response": str, "actions": list[dict] }
+    """
+    if not GEMINI_API_KEY:
+        return CHAT_UNAVAILABLE
+
+    conversation_history, payload = _start_turn(message, context, session_id)
     try:
         model_name = _normalize_gemini_model(GEMINI_MODEL)
-        contents = [
-            {
-                "role": "user" if item["role"] == "user" else "model",
-                "parts": [{"text": item["content"]}],
-            }
-            for item in conversation_history
-        ]
-
-        response = httpx.post(
+        response = await _gemini_client().post(
             f"{GEMINI_API_URL}/{model_name}:generateContent",
             params={"key": GEMINI_API_KEY},
             headers={"Content-Type": "application/json"},
-            json={
-                "system_instruction": {
-                    "parts": [{"text": SYSTEM_PROMPT}],
-                },
-                "contents": contents,
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "maxOutputTokens": 1024,
-                },
-            },
-            timeout=30.0,
+            json=payload,
         )
 
         if response.status_code != 200:
-            error_data = response.json()
-            error_msg = error_data.get("error", {}).get("message", f"HTTP {response.status_code}")
-            raise RuntimeError(error_msg)
-
-        data = response.json()
-        response_text = "".join(
-            part.get("text", "")
-            for part in data.get("candidates", [{}])[0]
-            .get("content", {})
-            .get("parts", [])
-        ).strip() or "I couldn't generate a response."
-        
-        # Add assistant response to history
-        conversation_history.append({
-            "role": "assistant",
-            "content": response_text,
-        })
-        
-        # Parse actions from response
-        actions = parse_actions(response_text)
-        display_text = strip_action_blocks(response_text)
-        
-        return {
-            "response": display_text,
-            "actions": actions,
-        }
-    
+            raise RuntimeError(_error_message(response))
+
+        return _finish_turn(conversation_history, _candidate_text(response.json()))
+
     except Exception as e:
         error_msg = f"Sorry, I encountered an error: {str(e)}"
         return {
@@ -250,6 +322,50 @@ def chat(message: str, context: Optional[dict] = None) -> dict:
         }
 
 
-def clear_history():
-    """Clear the conversation history."""
-    conversation_history.clear()
+async def chat_stream(message: str, context: Optional[dict] = None, session_id: str = "default"):
+    """
+    Streaming variant of chat(). Yields ("delta", text) as Gemini generates the
+    reply (raw, action blocks included), then a final ("done", {response, actions})
+    with the same shape chat() returns, once the whole reply is in.
+    """
+    if not GEMINI_API_KEY:
+        yield "done", CHAT_UNAVAILABLE
+        return
+
+    conversation_history, payload = _start_turn(message, context, session_id)
+    parts: list[str] = []
+    try:
+        model_name = _normalize_gemini_model(GEMINI_MODEL)
+        async with _gemini_client().stream(
+            "POST",
+            f"{GEMINI_API_URL}/{model_name}:streamGenerateContent",
+            params={"key": GEMINI_API_KEY, "alt": "sse"},
+            headers={"Content-Type": "application/json"},
+            json=payload,
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise RuntimeError(_error_message(response))
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                text = _candidate_text(orjson.loads(line[5:]))
+                if text:
+                    parts.append(text)
+                    yield "delta", text
+
+    except Exception as e:
+        yield "done", {
+            "response": f"Sorry, I encountered an error: {str(e)}",
+            "actions": [],
+        }
+        return
+
+    yield "done", _finish_turn(conversation_history, "".join(parts))
+
+
+def clear_history(session_id: str = "default"):
+    """Clear a session's conversation history."""
+    with _histories_lock:
+        _histories.pop(session_id, None)
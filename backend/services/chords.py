@@ -4,11 +4,15 @@ Supports common chord types (major, minor, 7th, dim, aug, sus, etc.)
 """
 
 import os
+import re
+from functools import lru_cache
+from itertools import groupby
+
 import pretty_midi
 import numpy as np
 import soundfile as sf
 
-from services.synth import render_midi_to_wav, INSTRUMENT_PROGRAMS
+from services.synth import SAMPLE_RATE, synthesize_notes
 from utils.file_helpers import generate_filepath
 
 # ---- Chord definitions (semitone intervals from root) ----
@@ -47,38 +51,35 @@ NOTE_MAP = {
     "B": 71, "Cb": 71,
 }
 
+# Qualities are matched case-insensitively
+_QUALITY_LOWER = {quality.lower(): intervals for quality, intervals in CHORD_INTERVALS.items()}
+_ROOT_QUALITY_RE = re.compile(r"^([A-G][#b]?)(.*)$", re.DOTALL)
+
 
-def parse_chord(symbol: str) -> list[int]:
+@lru_cache(maxsize=512)
+def parse_chord(symbol: str) -> tuple[int, ...]:
     """
     Parse a chord symbol like 'Cmaj7', 'Am', 'F#dim', 'Bb7' into MIDI note numbers.
-    Returns a list of MIDI pitches (in octave 4 region).
+    Returns a tuple of MIDI pitches (in octave 4 region); memoized, since the
+    same few symbols come back across requests.
     """
     symbol = symbol.strip()
     if not symbol:
         raise ValueError("Empty chord symbol")
 
-    # Extract root note (1 or 2 characters)
-    if len(symbol) >= 2 and symbol[1] in ('#', 'b'):
-        root_name = symbol[:2]
-        quality = symbol[2:]
-    else:
-        root_name = symbol[0]
-        quality = symbol[1:]
-
+    match = _ROOT_QUALITY_RE.match(symbol)
+    if match is None:
+        root_name = symbol[:2] if symbol[1:2] in ("#", "b") else symbol[:1]
+        raise ValueError(f"Unknown root note: '{root_name}' in chord '{symbol}'")
+    root_name, quality = match.groups()
+    # The pattern also admits spellings NOTE_MAP doesn't list (E#, B#)
     root_pitch = NOTE_MAP.get(root_name)
     if root_pitch is None:
         raise ValueError(f"Unknown root note: '{root_name}' in chord '{symbol}'")
 
-    # Normalize quality
     quality_lower = quality.lower()
-    
-    # Try exact match first, then progressively shorter matches
-    intervals = None
-    for key in sorted(CHORD_INTERVALS.keys(), key=len, reverse=True):
-        if quality_lower == key.lower():
-            intervals = CHORD_INTERVALS[key]
-            break
-    
+    intervals = _QUALITY_LOWER.get(quality_lower)
+
     if intervals is None:
         # Fallback: try common aliases
         if quality_lower.startswith("min") or quality_lower.startswith("m") and not quality_lower.startswith("maj"):
@@ -95,7 +96,7 @@ def parse_chord(symbol: str) -> list[int]:
             # Default to major
             intervals = CHORD_INTERVALS[""]
 
-    return [root_pitch + interval for interval in intervals]
+    return tuple(root_pitch + interval for interval in intervals)
 
 
 def generate_chord_progression(
@@ -108,7 +109,7 @@ def generate_chord_progression(
     pattern: str = "block",
 ) -> str:
     """
-    Generate a MIDI file from a chord progression.
+    Synthesize a chord progression and render it to WAV.
     
     Args:
         chords: List of chord symbols (e.g. ["Cmaj", "Am", "F", "G7"])
@@ -129,62 +130,81 @@ def generate_chord_progression(
     print(f"   Instrument: {instrument}, Pattern: {pattern}")
     print("=" * 60)
 
-    # Create MIDI
-    midi = pretty_midi.PrettyMIDI(initial_tempo=bpm)
-    program = INSTRUMENT_PROGRAMS.get(instrument, 0)
-    midi_instrument = pretty_midi.Instrument(program=program, name=instrument)
-
     seconds_per_beat = 60.0 / bpm
-
-    for chord_idx, chord_symbol in enumerate(chords):
-        try:
-            pitches = parse_chord(chord_symbol)
-        except ValueError as e:
-            print(f"   ⚠️ Skipping chord '{chord_symbol}': {e}")
-            continue
-
-        # Apply octave shift
-        pitches = [p + (octave_shift * 12) for p in pitches]
-        # Clamp to valid MIDI range
-        pitches = [max(0, min(127, p)) for p in pitches]
-
-        chord_start = chord_idx * beats_per_chord * seconds_per_beat
-        chord_duration = beats_per_chord * seconds_per_beat
-
-        if pattern == "arpeggiated":
-            # Arpeggiate: each note starts slightly after the previous
-            arp_delay = seconds_per_beat / len(pitches)  # spread across one beat
-            for note_idx, pitch in enumerate(pitches):
-                note_start = chord_start + (note_idx * arp_delay)
-                note_end = chord_start + chord_duration
-                note = pretty_midi.Note(
-                    velocity=velocity,
-                    pitch=pitch,
-                    start=note_start,
-                    end=note_end,
-                )
-                midi_instrument.notes.append(note)
-        else:
-            # Block chord: all notes play together
-            for pitch in pitches:
-                note = pretty_midi.Note(
-                    velocity=velocity,
-                    pitch=pitch,
-                    start=chord_start,
-                    end=chord_start + chord_duration,
-                )
-                midi_instrument.notes.append(note)
-
-    midi.instruments.append(midi_instrument)
-
-    # Save MIDI to temp file
-    midi_path = generate_filepath("mid")
-    midi.write(midi_path)
-    print(f"   ✅ MIDI saved: {os.path.basename(midi_path)} ({len(midi_instrument.notes)} notes)")
-
-    # Render to WAV using FluidSynth
-    wav_path = render_midi_to_wav(midi_path, instrument)
+    chord_duration = beats_per_chord * seconds_per_beat
+
+    # Repeated chords are run-length encoded and each distinct chord is
+    # synthesized only once; copies are overlap-added at every slot it plays in.
+    runs = [(symbol, sum(1 for _ in group)) for symbol, group in groupby(chords)]
+    blocks: dict[str, np.ndarray | None] = {}
+    placements: list[tuple[int, np.ndarray]] = []
+
+    chord_idx = 0
+    for chord_symbol, count in runs:
+        if chord_symbol not in blocks:
+            try:
+                pitches = parse_chord(chord_symbol)
+            except ValueError as e:
+                print(f"   ⚠️ Skipping chord '{chord_symbol}': {e}")
+                blocks[chord_symbol] = None
+            else:
+                # Apply octave shift
+                pitches = [p + (octave_shift * 12) for p in pitches]
+                # Clamp to valid MIDI range
+                pitches = [max(0, min(127, p)) for p in pitches]
+                notes = _chord_notes(pitches, chord_duration, seconds_per_beat, velocity, pattern)
+                blocks[chord_symbol] = synthesize_notes(notes, instrument)
+
+        block = blocks[chord_symbol]
+        if block is not None:
+            for slot in range(chord_idx, chord_idx + count):
+                placements.append((int(round(slot * chord_duration * SAMPLE_RATE)), block))
+        chord_idx += count
+
+    rendered = sum(block is not None for block in blocks.values())
+    print(f"   ✅ Synthesized {rendered} unique chord(s) for {len(placements)} slot(s)")
+
+    total_samples = max((start + len(block) for start, block in placements), default=0)
+    audio = np.zeros(total_samples, dtype=np.float32)
+    for start, block in placements:
+        audio[start:start + len(block)] += block
+
+    # Normalize to prevent clipping
+    peak = max(audio.max(), -audio.min()) if total_samples else 0.0
+    if peak > 0:
+        np.multiply(audio, 0.9 / peak, out=audio)
+
+    wav_path = generate_filepath("wav")
+    sf.write(wav_path, audio, SAMPLE_RATE, subtype="PCM_16")
     print(f"   ✅ WAV rendered: {os.path.basename(wav_path)}")
     print("=" * 60)
 
     return wav_path
+
+
+def _chord_notes(
+    pitches: list[int],
+    chord_duration: float,
+    seconds_per_beat: float,
+    velocity: int,
+    pattern: str,
+) -> list[pretty_midi.Note]:
+    """Build the notes for one chord, starting at time 0."""
+    if pattern == "arpeggiated":
+        # Arpeggiate: each note starts slightly after the previous
+        arp_delay = seconds_per_beat / len(pitches)  # spread across one beat
+        return [
+            pretty_midi.Note(
+                velocity=velocity,
+                pitch=pitch,
+                start=note_idx * arp_delay,
+                end=chord_duration,
+            )
+            for note_idx, pitch in enumerate(pitches)
+        ]
+
+    # Block chord: all notes play together
+    return [
+        pretty_midi.Note(velocity=velocity, pitch=pitch, start=0.0, end=chord_duration)
+        for pitch in pitches
+    ]
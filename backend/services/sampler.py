@@ -7,16 +7,71 @@ Works like a basic sampler:
 3. Place each shifted note at the correct time position and mix together.
 """
 
+import io
 import os
+from fractions import Fraction
+
 import numpy as np
 import librosa
 import soundfile as sf
 import pretty_midi
+from numba import njit
+from scipy.signal import resample_poly
 
 from utils.file_helpers import generate_filepath
 
 SAMPLE_RATE = 44100
 
+# Pitch detection only looks at C2–C6 (≤ 1 kHz), so it runs at a quarter of
+# SAMPLE_RATE with a frame length covering the same 46 ms window
+PITCH_SR = 11025
+PITCH_FRAME_LENGTH = 512
+# A one-shot's pitch is settled within its first couple of seconds
+PITCH_MAX_SEC = 2.0
+# yin is tried first; if its estimates over the audible frames spread wider
+# than this (octave errors, noisy attack), pyin's HMM decides instead
+YIN_MAX_SPREAD_SEMITONES = 0.5
+YIN_MIN_RMS_RATIO = 0.1     # Frames quieter than this fraction of the peak RMS are ignored
+# Leading/trailing audio this far below the peak is cut before yin/pyin run on it
+PITCH_TRIM_TOP_DB = 40
+
+# Resampler used by pitch_shift and the pitch-detection load. pitch_shift's
+# artifacts are masked by the phase vocoder's, and pitch tracking below 1 kHz
+# doesn't care, so the quick soxr preset is enough. ("polyphase" can't be used: pitch shifts
+# resample by non-integer ratios, which it rejects.)
+SAMPLER_RES_TYPE = "soxr_qq"
+
+# By default notes are shifted like a classic sampler: the sample is resampled
+# by 2**(n/12), so higher notes also play shorter. preserve_duration=True keeps
+# the sample's length with librosa's phase vocoder instead (several times slower).
+# Resampling ratios are approximated by fractions with at most this denominator
+# (well under a cent off).
+RESAMPLE_MAX_DENOMINATOR = 1000
+
+
+@njit(cache=True, nogil=True)
+def _mix_notes(output, bank, bank_idx, starts, lengths, gains, fade_lens):
+    """
+    Add every note's (velocity-scaled, possibly trimmed) pitch-shifted copy into
+    output in one compiled pass. Serial on purpose: overlapping notes write the
+    same output samples.
+    """
+    for k in range(len(starts)):
+        if gains[k] == 0.0:
+            continue  # velocity 0: nothing to add
+        voice = bank[bank_idx[k]]
+        length = lengths[k]
+        fade_len = fade_lens[k]
+        fade_start = length - fade_len
+        out = output[starts[k]:starts[k] + length]
+        for i in range(length):
+            value = voice[i] * gains[k]
+            if i >= fade_start:
+                # Same ramp as np.linspace(1.0, 0.0, fade_len)
+                step = (i - fade_start) / (fade_len - 1) if fade_len > 1 else 0.0
+                value = np.float32(value * (1.0 - step))
+            out[i] += value
+
 
 def detect_base_pitch(wav_path: str) -> float:
     """
@@ -24,15 +79,68 @@ def detect_base_pitch(wav_path: str) -> float:
     Returns the MIDI note number (float) of the detected pitch.
     Falls back to C4 (60) if detection fails.
     """
-    y, sr = librosa.load(wav_path, sr=SAMPLE_RATE, mono=True)
+    y, sr = librosa.load(wav_path, sr=PITCH_SR, mono=True, duration=PITCH_MAX_SEC, res_type=SAMPLER_RES_TYPE)
+    return detect_base_pitch_from_array(y, sr)
+
 
-    # Use pyin for robust pitch detection
-    f0, voiced_flag, voiced_probs = librosa.pyin(
+def _yin_midi(y: np.ndarray, sr: int) -> float | None:
+    """
+    Median yin pitch (MIDI) over the audible frames, or None when the frames
+    disagree too much to trust it.
+    """
+    frame_length = round(PITCH_FRAME_LENGTH * sr / PITCH_SR)
+    if len(y) < frame_length:
+        return None
+    f0 = librosa.yin(
         y,
         fmin=librosa.note_to_hz('C2'),
         fmax=librosa.note_to_hz('C6'),
         sr=sr,
+        frame_length=frame_length,
     )
+    rms = librosa.feature.rms(y=y, frame_length=frame_length, hop_length=frame_length // 4)[0]
+    if rms.max() <= 0:
+        return None
+    audible = rms[:len(f0)] >= YIN_MIN_RMS_RATIO * rms.max()
+    midi = librosa.hz_to_midi(f0[audible])
+    low, high = np.percentile(midi, [25, 75])
+    if high - low > YIN_MAX_SPREAD_SEMITONES:
+        return None
+    return float(np.median(midi))
+
+
+def _pyin(y: np.ndarray, sr: int):
+    return librosa.pyin(
+        y,
+        fmin=librosa.note_to_hz('C2'),
+        fmax=librosa.note_to_hz('C6'),
+        sr=sr,
+        frame_length=round(PITCH_FRAME_LENGTH * sr / PITCH_SR),
+    )
+
+
+def warm_up() -> None:
+    """Run pyin and the mixer once so numba compiles their kernels before the first sample upload."""
+    _pyin(np.zeros(PITCH_SR, dtype=np.float32), PITCH_SR)
+    one = np.ones(1, dtype=np.int64)
+    _mix_notes(np.zeros(2, dtype=np.float32), np.zeros((1, 2), dtype=np.float32),
+               one - 1, one - 1, one, np.ones(1, dtype=np.float32), one)
+
+
+def detect_base_pitch_from_array(y: np.ndarray, sr: int) -> float:
+    """detect_base_pitch for already-loaded mono audio."""
+    # Silent head/tail carries no pitch; don't spend yin/pyin frames on it
+    frame_length = round(PITCH_FRAME_LENGTH * sr / PITCH_SR)
+    y, _ = librosa.effects.trim(y, top_db=PITCH_TRIM_TOP_DB, frame_length=frame_length, hop_length=frame_length // 4)
+
+    midi_note = _yin_midi(y, sr)
+    if midi_note is not None:
+        note_name = librosa.midi_to_note(round(midi_note))
+        print(f"[Sampler] 🎵 Detected base pitch (yin): MIDI {midi_note:.1f} ({note_name})")
+        return midi_note
+
+    # yin was unsure: fall back to pyin for robust pitch detection
+    f0, voiced_flag, voiced_probs = _pyin(y, sr)
 
     # Get the median of voiced frames (ignoring NaN/unvoiced)
     voiced_f0 = f0[voiced_flag] if voiced_flag is not None else f0[~np.isnan(f0)]
@@ -48,10 +156,26 @@ def detect_base_pitch(wav_path: str) -> float:
     return float(midi_note)
 
 
+def _load_sample(sample_path: str) -> tuple[np.ndarray, int]:
+    """Mono float32 audio at SAMPLE_RATE; read directly when the file already is."""
+    info = sf.info(sample_path)
+    if info.samplerate == SAMPLE_RATE and info.channels == 1:
+        return sf.read(sample_path, dtype="float32")[0], SAMPLE_RATE
+    sample, sr = librosa.load(sample_path, sr=SAMPLE_RATE, mono=True)
+    return sample.astype(np.float32, copy=False), sr
+
+
+def _shift_by_resampling(sample: np.ndarray, n_steps: float) -> np.ndarray:
+    """Play the sample n_steps semitones higher by resampling it (duration scales by 2**(-n/12))."""
+    ratio = Fraction(2 ** (n_steps / 12)).limit_denominator(RESAMPLE_MAX_DENOMINATOR)
+    return resample_poly(sample, ratio.denominator, ratio.numerator).astype(np.float32, copy=False)
+
+
 def render_with_sample(
-    midi_path: str,
+    midi_path: str | bytes,
     sample_path: str,
     base_pitch: float | None = None,
+    preserve_duration: bool = False,
 ) -> str:
     """
     Render a MIDI file using a one-shot sample instead of FluidSynth.
@@ -60,21 +184,23 @@ def render_with_sample(
     scaled by velocity, trimmed/padded to note duration, and placed in time.
 
     Args:
-        midi_path:   Path to the MIDI file.
+        midi_path:   Path to the MIDI file, or its bytes.
         sample_path: Path to the one-shot WAV sample.
         base_pitch:  MIDI note number of the sample's pitch (auto-detected if None).
+        preserve_duration: Pitch-shift with the phase vocoder so every note keeps
+                     the sample's length, instead of resampling it.
 
     Returns:
         Path to the rendered WAV file.
     """
     print("=" * 60)
     print("🎹 CUSTOM SAMPLE RENDERING")
-    print(f"📁 MIDI:   {os.path.basename(midi_path)}")
+    print(f"📁 MIDI:   {'<in memory>' if isinstance(midi_path, bytes) else os.path.basename(midi_path)}")
     print(f"🔊 Sample: {os.path.basename(sample_path)}")
     print("=" * 60)
 
     # Load the sample
-    sample, sr = librosa.load(sample_path, sr=SAMPLE_RATE, mono=True)
+    sample, sr = _load_sample(sample_path)
     print(f"[Sampler] Sample loaded: {len(sample)} samples ({len(sample)/sr:.2f}s)")
 
     # Detect base pitch if not provided
@@ -83,71 +209,72 @@ def render_with_sample(
     print(f"[Sampler] Base pitch: MIDI {base_pitch:.1f}")
 
     # Load MIDI
-    midi = pretty_midi.PrettyMIDI(midi_path)
+    midi = pretty_midi.PrettyMIDI(io.BytesIO(midi_path) if isinstance(midi_path, bytes) else midi_path)
     end_time = midi.get_end_time()
     if end_time <= 0:
         end_time = 1.0
 
-    # Allocate output buffer (with 1s padding)
+    # Note attributes as parallel arrays, read from pretty_midi once
+    notes = [note for inst in midi.instruments for note in inst.notes]
+    total_notes = len(notes)
+    pitches = np.fromiter((note.pitch for note in notes), dtype=np.int64, count=total_notes)
+    gains = np.fromiter((note.velocity for note in notes), dtype=np.float32, count=total_notes) / 127.0
+    starts = np.fromiter((int(note.start * sr) for note in notes), dtype=np.int64, count=total_notes)
+    durations = np.fromiter((int((note.end - note.start) * sr) for note in notes), dtype=np.int64, count=total_notes)
+
+    # Pitch-shifted copies of the sample, one per distinct MIDI pitch: each
+    # pitch is shifted once, however many notes play it
+    unique_pitches, bank_idx = np.unique(pitches, return_inverse=True)
+    voices = []
+    for pitch in unique_pitches.tolist():
+        # Semitone shift from sample's base pitch to the target note
+        n_steps = pitch - base_pitch
+        if abs(n_steps) < 0.01:
+            voices.append(sample)
+        elif preserve_duration:
+            voices.append(librosa.effects.pitch_shift(
+                y=sample,
+                sr=sr,
+                n_steps=n_steps,
+                res_type=SAMPLER_RES_TYPE,
+            ))
+        else:
+            voices.append(_shift_by_resampling(sample, n_steps))
+
+    # One zero-padded row per pitch, so the mixer can index them by note
+    voice_lengths = np.array([len(voice) for voice in voices], dtype=np.int64)
+    bank = np.zeros((len(voices), voice_lengths.max(initial=0)), dtype=np.float32)
+    for row, voice in enumerate(voices):
+        bank[row, :len(voice)] = voice
+    # Flush subnormal values (decayed tails of the sample and its filters' ringing)
+    # to zero once here; feeding them through the mixer is very slow on x86
+    bank[np.abs(bank) < np.finfo(np.float32).tiny] = 0.0
+
+    # Notes shorter than their shifted sample are cut to their duration and faded
+    # out at the end to avoid clicks; longer ones play it whole (natural decay)
+    note_voice_lengths = voice_lengths[bank_idx]
+    trimmed = durations < note_voice_lengths
+    lengths = np.where(trimmed, durations, note_voice_lengths)
+    fade_lens = np.where(trimmed, np.minimum(int(0.01 * sr), durations), 0)
+
+    # Allocate output buffer (with 1s padding), long enough for every note
     output_length = int((end_time + 1.0) * sr)
+    if total_notes:
+        output_length = max(output_length, int((starts + lengths).max()))
     output = np.zeros(output_length, dtype=np.float32)
 
-    total_notes = 0
-
-    for inst in midi.instruments:
-        for note in inst.notes:
-            total_notes += 1
-
-            # Semitone shift from sample's base pitch to the target note
-            n_steps = note.pitch - base_pitch
-
-            # Pitch-shift the sample
-            if abs(n_steps) < 0.01:
-                shifted = sample.copy()
-            else:
-                shifted = librosa.effects.pitch_shift(
-                    y=sample,
-                    sr=sr,
-                    n_steps=n_steps,
-                )
-
-            # Scale by velocity (0-127 → 0.0-1.0)
-            velocity_scale = note.velocity / 127.0
-            shifted = shifted * velocity_scale
-
-            # Determine note duration in samples
-            note_dur_samples = int((note.end - note.start) * sr)
-
-            # Trim or pad the shifted sample to match note duration
-            if len(shifted) > note_dur_samples:
-                # Apply a short fade-out at the end to avoid clicks
-                fade_len = min(int(0.01 * sr), note_dur_samples)
-                shifted = shifted[:note_dur_samples]
-                if fade_len > 0:
-                    fade = np.linspace(1.0, 0.0, fade_len)
-                    shifted[-fade_len:] *= fade
-            # If sample is shorter than note, just use as-is (natural decay)
-
-            # Place in the output buffer
-            start_sample = int(note.start * sr)
-            end_sample = start_sample + len(shifted)
-
-            # Extend output if needed
-            if end_sample > len(output):
-                output = np.pad(output, (0, end_sample - len(output)))
-
-            output[start_sample:end_sample] += shifted
+    _mix_notes(output, bank, bank_idx, starts, lengths, gains, fade_lens)
 
-    print(f"[Sampler] ✅ Rendered {total_notes} notes with custom sample")
+    print(f"[Sampler] ✅ Rendered {total_notes} notes with custom sample ({len(unique_pitches)} distinct pitches)")
 
     # Normalize to prevent clipping
-    peak = np.max(np.abs(output))
+    peak = max(output.max(), -output.min())
     if peak > 0:
-        output = output / peak * 0.9
+        np.multiply(output, 0.9 / peak, out=output)
 
     # Write output
     output_path = generate_filepath("wav")
-    sf.write(output_path, output, sr)
+    sf.write(output_path, output, sr, subtype="PCM_16")
     print(f"[Sampler] 💾 Output: {os.path.basename(output_path)}")
     print("=" * 60)
 
@@ -1,6 +1,14 @@
+import io
+import operator
 import os
+import queue
+import threading
+from concurrent.futures import Future
+from math import gcd
+
 import numpy as np
 import soundfile as sf
+from scipy.signal import resample_poly
 
 # Try to import fluidsynth, but handle the DLL path issue gracefully
 try:
@@ -83,6 +91,23 @@ INSTRUMENT_PROGRAMS = {
 }
 
 SAMPLE_RATE = 44100
+PREVIEW_SAMPLE_RATE = 22050  # ?quality=preview: 16-bit mono at half rate
+
+# Independent FluidSynth instances rendering in parallel. FluidSynth's sample
+# cache shares the loaded SoundFont data between them, so each extra synth
+# costs voice/state memory only.
+RENDER_WORKERS = int(os.environ.get("SINATRA_RENDER_WORKERS", min(os.cpu_count() or 1, 4)))
+# Voice-rendering threads inside each synth (FluidSynth's synth.cpu-cores).
+# By default the cores left over by the pool are shared out, up to 4 per synth.
+SYNTH_CPU_CORES = int(os.environ.get(
+    "SINATRA_SYNTH_CORES", max(1, min((os.cpu_count() or 1) // max(1, RENDER_WORKERS), 4))
+))
+
+# Full renders are pulled from FluidSynth this many frames at a time and
+# streamed to disk, so memory stays flat however long the MIDI is
+RENDER_BLOCK_FRAMES = 4096
+# MIDI channels for melodic instruments (9 is GM percussion)
+MELODIC_CHANNELS = [c for c in range(16) if c != 9]
 
 
 def _find_soundfont() -> str:
@@ -107,25 +132,238 @@ def _find_soundfont() -> str:
     )
 
 
-def render_midi_to_wav(
-    midi_path: str,
-    instrument: str = "Piano",
-) -> str:
-    """
-    Render a MIDI file to WAV using FluidSynth.
-    """
+def _require_fluidsynth() -> None:
     if not HAS_FLUIDSYNTH:
         raise RuntimeError(
             "FluidSynth is not available. Please install FluidSynth:\n"
             "Windows: Download from https://www.fluidsynth.org/ or use: choco install fluidsynth\n"
             "Then ensure the FluidSynth bin directory is in your PATH."
         )
-    
-    sf2_path = _find_soundfont()
-    output_path = generate_filepath("wav")
+
+
+class RenderWorker:
+    """
+    A long-lived FluidSynth instance on its own thread.
+
+    The SoundFont is loaded once when the worker starts, and render jobs are
+    pulled from a queue (shared with the other workers of a RenderPool). No
+    request pays for creating a synth or reloading the .sf2.
+    """
+
+    def __init__(self, sf2_path: str, jobs: queue.Queue, name: str = "fluidsynth-render"):
+        self.sf2_path = sf2_path
+        self._jobs = jobs
+        self._ready = threading.Event()
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self) -> "RenderWorker":
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def join(self) -> None:
+        self._thread.join()
+
+    def _run(self) -> None:
+        try:
+            # cpu-cores is read when the synth is created, so it goes in with the constructor
+            synth = fluidsynth.Synth(samplerate=float(SAMPLE_RATE), **{"synth.cpu-cores": SYNTH_CPU_CORES})
+            sfid = synth.sfload(self.sf2_path)
+            if sfid == -1:
+                raise FileNotFoundError(f"FluidSynth could not load SoundFont: {self.sf2_path}")
+        except BaseException as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        while (item := self._jobs.get()) is not None:
+            job, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(job(synth, sfid))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                # Silence any lingering voices and controllers before the next job
+                synth.system_reset()
+        synth.delete()
+
+
+class RenderPool:
+    """
+    N RenderWorkers, each with its own synth, fed from one bounded job queue.
+    A synth is only ever touched by its own thread, so concurrent renders run
+    in parallel without a global lock.
+    """
+
+    def __init__(self, sf2_path: str, size: int = RENDER_WORKERS, max_pending: int = 32):
+        self.sf2_path = sf2_path
+        self._jobs: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._workers = [
+            RenderWorker(sf2_path, self._jobs, name=f"fluidsynth-render-{i}") for i in range(max(1, size))
+        ]
+
+    def start(self) -> "RenderPool":
+        started = []
+        try:
+            for worker in self._workers:
+                started.append(worker.start())
+        except BaseException:
+            self._workers = started
+            self.stop()
+            raise
+        return self
+
+    def submit(self, job) -> Future:
+        """Queue job(synth, sfid) for the next free synth; blocks while the queue is full."""
+        future: Future = Future()
+        self._jobs.put((job, future))
+        return future
+
+    def stop(self) -> None:
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+
+_render_worker: RenderPool | None = None
+_render_worker_lock = threading.Lock()
+
+
+def start_render_worker() -> RenderPool:
+    """Start the shared render pool if it isn't running yet (called at app startup)."""
+    global _render_worker
+    _require_fluidsynth()
+    with _render_worker_lock:
+        if _render_worker is None:
+            _render_worker = RenderPool(_find_soundfont()).start()
+            print(
+                f"🎛️ FluidSynth render pool ready: {len(_render_worker)} synth(s) x {SYNTH_CPU_CORES} core(s) "
+                f"({os.path.basename(_render_worker.sf2_path)})"
+            )
+        return _render_worker
+
+
+def stop_render_worker() -> None:
+    global _render_worker
+    with _render_worker_lock:
+        if _render_worker is not None:
+            _render_worker.stop()
+            _render_worker = None
+
+
+def _synthesize(midi_obj) -> np.ndarray:
+    """Run midi_obj.fluidsynth(...) on the next free synth of the render pool and wait for the audio."""
+    def job(synth, sfid):
+        return midi_obj.fluidsynth(fs=SAMPLE_RATE, synthesizer=synth, sfid=sfid)
+
+    return start_render_worker().submit(job).result()
+
+
+def synthesize_notes(notes: list, instrument: str = "Piano") -> np.ndarray:
+    """
+    Render a list of pretty_midi Notes to raw, un-normalized mono audio at SAMPLE_RATE.
+    Lets callers render a fragment once and place it several times in a longer mix.
+    """
+    _require_fluidsynth()
+    midi_instrument = pretty_midi.Instrument(program=INSTRUMENT_PROGRAMS.get(instrument, 0))
+    midi_instrument.notes.extend(notes)
+    return _synthesize(midi_instrument)
+
+
+def _midi_events(synth, sfid: int, midi) -> list[tuple]:
+    """
+    Select each instrument's program on its own channel and return every note,
+    pitch bend and controller event as (time, order, kind, channel, a, b),
+    sorted the way pretty_midi orders them (note-offs first at equal times).
+    """
+    events = []
+    for index, inst in enumerate(midi.instruments):
+        if inst.is_drum:
+            channel = 9
+            if synth.program_select(channel, sfid, 128, inst.program) == -1:
+                synth.program_select(channel, sfid, 128, 0)
+        else:
+            channel = MELODIC_CHANNELS[index % len(MELODIC_CHANNELS)]
+            synth.program_select(channel, sfid, 0, inst.program)
+        for note in inst.notes:
+            events.append((note.start, 1, "note on", channel, note.pitch, note.velocity))
+            events.append((note.end, 0, "note off", channel, note.pitch, 0))
+        for bend in inst.pitch_bends:
+            events.append((bend.time, 1, "pitch bend", channel, bend.pitch, 0))
+        for control_change in inst.control_changes:
+            events.append((control_change.time, 1, "control change", channel, control_change.number, control_change.value))
+    events.sort(key=operator.itemgetter(0, 1))
+    return events
+
+
+def _stream_midi(synth, sfid: int, midi):
+    """
+    Yield the left channel of the whole MIDI as float32 blocks of at most
+    RENDER_BLOCK_FRAMES. All instruments play on one synth, each on its own
+    channel; like pretty_midi, one second of tail follows the last event.
+    """
+    events = _midi_events(synth, sfid, midi)
+    if not events:
+        return
+
+    def pull(frames: int):
+        while frames > 0:
+            block = min(frames, RENDER_BLOCK_FRAMES)
+            yield synth.get_samples(block)[::2].astype(np.float32)
+            frames -= block
+
+    cursor = 0
+    for time, _, kind, channel, a, b in events:
+        position = int(SAMPLE_RATE * time)
+        yield from pull(position - cursor)
+        cursor = max(cursor, position)
+        if kind == "note on":
+            synth.noteon(channel, a, b)
+        elif kind == "note off":
+            synth.noteoff(channel, a)
+        elif kind == "pitch bend":
+            synth.pitch_bend(channel, a)
+        else:
+            synth.cc(channel, a, b)
+    yield from pull(int(np.ceil(SAMPLE_RATE * (events[-1][0] + 1.0))) - cursor)
+
+
+def warm_up() -> None:
+    """
+    Start the render worker and play one short note per instrument so the
+    SoundFont's samples and voice tables are paged in before the first render.
+    """
+    start_render_worker()
+    for program in sorted(set(INSTRUMENT_PROGRAMS.values())):
+        midi_instrument = pretty_midi.Instrument(program=program)
+        midi_instrument.notes.append(pretty_midi.Note(velocity=64, pitch=60, start=0.0, end=0.1))
+        _synthesize(midi_instrument)
+
+
+def render_midi_to_wav(
+    midi_path: str | bytes,
+    instrument: str = "Piano",
+    output_path: str | None = None,
+) -> str:
+    """
+    Render a MIDI file (a path, or the file's bytes) to WAV using FluidSynth.
+    Writes to a new file in the uploads directory unless output_path is given.
+    """
+    _require_fluidsynth()
+    output_path = output_path or generate_filepath("wav")
 
     # Load the MIDI
-    midi = pretty_midi.PrettyMIDI(midi_path)
+    midi = pretty_midi.PrettyMIDI(io.BytesIO(midi_path) if isinstance(midi_path, bytes) else midi_path)
 
     # Optionally remap all instruments to the selected program
     program = INSTRUMENT_PROGRAMS.get(instrument, 0)
@@ -133,14 +371,48 @@ def render_midi_to_wav(
         inst.program = program
         inst.is_drum = False
 
-    # Synthesize using pretty_midi's fluidsynth integration
-    audio = midi.fluidsynth(fs=SAMPLE_RATE, sf2_path=sf2_path)
+    # Stream the synth's output to a float scratch file on the shared FluidSynth
+    # worker (SoundFont already loaded), tracking the peak as blocks go out
+    scratch_path = output_path + ".part"
+
+    def job(synth, sfid):
+        peak = 0.0
+        with sf.SoundFile(scratch_path, "w", SAMPLE_RATE, 1, subtype="FLOAT", format="WAV") as scratch:
+            for block in _stream_midi(synth, sfid, midi):
+                peak = max(peak, float(block.max()), float(-block.min()))
+                scratch.write(block)
+        return peak
+
+    try:
+        peak = start_render_worker().submit(job).result()
 
-    # Normalize to prevent clipping
-    if np.max(np.abs(audio)) > 0:
-        audio = audio / np.max(np.abs(audio)) * 0.9
+        # Normalize to prevent clipping, block by block into the final 16-bit WAV
+        gain = 0.9 / peak if peak > 0 else 1.0
+        with sf.SoundFile(output_path, "w", SAMPLE_RATE, 1, subtype="PCM_16", format="WAV") as out:
+            for block in sf.blocks(scratch_path, blocksize=RENDER_BLOCK_FRAMES * 16, dtype="float32"):
+                np.multiply(block, gain, out=block)
+                out.write(block)
+    finally:
+        try:
+            os.remove(scratch_path)
+        except OSError:
+            pass
+
+    return output_path
 
-    # Write to WAV
-    sf.write(output_path, audio, SAMPLE_RATE)
 
+def downmix_to_preview(wav_path: str, output_path: str | None = None) -> str:
+    """
+    Write a 16-bit mono PREVIEW_SAMPLE_RATE copy of a WAV, for previews where
+    bandwidth matters more than fidelity. Returns the new file's path.
+    """
+    output_path = output_path or generate_filepath("wav")
+    audio, sr = sf.read(wav_path, dtype="float32", always_2d=True)
+    audio = audio.mean(axis=1)
+    if sr != PREVIEW_SAMPLE_RATE:
+        g = gcd(PREVIEW_SAMPLE_RATE, sr)
+        audio = resample_poly(audio, PREVIEW_SAMPLE_RATE // g, sr // g)
+    # The resampling filter can overshoot slightly; clip rather than wrap in PCM_16
+    np.clip(audio, -1.0, 1.0, out=audio)
+    sf.write(output_path, audio, PREVIEW_SAMPLE_RATE, subtype="PCM_16")
     return output_path
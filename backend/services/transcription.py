@@ -6,8 +6,20 @@ It handles polyphonic audio and is far more accurate than pYIN for melodies.
 We run it via ONNX Runtime (no TensorFlow needed).
 """
 
+import hashlib
 import os
+import platform
+import queue
+import tempfile
+import threading
+import time
 import warnings
+from concurrent.futures import Future
+from functools import lru_cache
+
+import numpy as np
+import pretty_midi
+import soundfile as sf
 
 # Suppress noisy warnings from basic-pitch about missing optional backends
 warnings.filterwarnings("ignore", message=".*Coremltools is not installed.*")
@@ -16,8 +28,11 @@ warnings.filterwarnings("ignore", message=".*Tensorflow is not installed.*")
 warnings.filterwarnings("ignore", message=".*pkg_resources is deprecated.*")
 
 try:
-    from basic_pitch.inference import predict
+    from basic_pitch.inference import Model, predict
+    from basic_pitch.inference import get_audio_input, unwrap_output
     from basic_pitch import ICASSP_2022_MODEL_PATH
+    from basic_pitch.constants import AUDIO_SAMPLE_RATE, FFT_HOP, AUDIO_N_SAMPLES
+    import basic_pitch.note_creation as infer
     if predict is None:
         raise ImportError("basic_pitch.inference.predict is None - basic-pitch may not be properly installed")
 except ImportError as e:
@@ -25,8 +40,43 @@ except ImportError as e:
     print("   This is required for vocal-to-MIDI transcription.")
     raise
 
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
 from utils.file_helpers import generate_filepath
 
+# ---- Inference device ----
+# "auto" = CUDA if onnxruntime-gpu sees a GPU, then DirectML / CoreML, else CPU;
+# "cuda" / "cpu" force one;
+# "int8" = CPU with a dynamically quantized copy of the model (needs the `onnx` package)
+# "fp16" = CUDA with a half-precision copy of the model (needs `onnx` + `onnxconverter-common`)
+SINATRA_DEVICE = os.environ.get("SINATRA_DEVICE", "auto").lower()
+# Intra-op threads for the ONNX session (0 = ONNX Runtime's default, one per physical core)
+ORT_THREADS = int(os.environ.get("SINATRA_ORT_THREADS", 0))
+# Tried after CUDA for "auto" / "gpu"
+GPU_FALLBACK_PROVIDERS = ["DmlExecutionProvider", "CoreMLExecutionProvider"]
+MODEL_CACHE_DIR = os.environ.get(
+    "SINATRA_MODEL_CACHE", os.path.join(tempfile.gettempdir(), "sinatra-models")
+)
+
+# ---- Batched inference ----
+BATCH_LINGER_SEC = 0.01     # How long the batcher waits for other transcriptions to join a run
+MAX_BATCH_WINDOWS = 64      # ~2s audio windows per session run (bounds activation memory)
+BATCH_RESULT_TIMEOUT_SEC = 120  # Give up on a queued run instead of blocking a request forever
+N_OVERLAPPING_FRAMES = 30   # Same windowing as basic_pitch.inference.run_inference
+OVERLAP_LEN = N_OVERLAPPING_FRAMES * FFT_HOP
+HOP_SIZE = AUDIO_N_SAMPLES - OVERLAP_LEN
+
+# Tensor names of the ICASSP 2022 ONNX graph (as used by basic_pitch.inference.Model)
+ONNX_INPUT_NAME = "serving_default_input_2:0"
+ONNX_OUTPUT_NAMES = {
+    "note": "StatefulPartitionedCall:1",
+    "onset": "StatefulPartitionedCall:2",
+    "contour": "StatefulPartitionedCall:0",
+}
+
 # ---- Tuning knobs ----
 ONSET_THRESHOLD = 0.6       # Higher = only strong note onsets (was 0.5)
 FRAME_THRESHOLD = 0.45      # Higher = only confident frames count (was 0.3)
@@ -40,6 +90,9 @@ MIN_VELOCITY = 40               # Drop very quiet notes
 MERGE_GAP_SEC = 0.06            # Merge same-pitch notes separated by < 60ms
 MAX_NOTES_PER_SECOND = 8        # Cap to prevent machine-gun note spam
 
+# Grid cells per beat for each quantize setting
+QUANTIZE_DIVISIONS = {"1/4": 1, "1/8": 2, "1/16": 4, "1/32": 8}
+
 # ---- Scale definitions (pitch classes 0-11, where 0=C, 1=C#, ..., 11=B) ----
 SCALE_INTERVALS = {
     "major":     [0, 2, 4, 5, 7, 9, 11],
@@ -59,44 +112,471 @@ KEY_OFFSETS = {
 }
 
 
-def _build_scale_set(key: str, scale: str) -> set[int]:
-    """Build a set of all valid MIDI note numbers (0-127) for a given key+scale."""
-    root = KEY_OFFSETS.get(key, 0)
-    intervals = SCALE_INTERVALS.get(scale, SCALE_INTERVALS["chromatic"])
-    pitch_classes = set((root + i) % 12 for i in intervals)
-    return {midi for midi in range(128) if midi % 12 in pitch_classes}
+def _select_providers() -> list[str]:
+    """ONNX Runtime execution providers for SINATRA_DEVICE, best first."""
+    available = ort.get_available_providers()
+    if SINATRA_DEVICE in ("auto", "cuda", "gpu", "fp16") and "CUDAExecutionProvider" in available:
+        return ["CUDAExecutionProvider", "CPUExecutionProvider"]
+    if SINATRA_DEVICE in ("auto", "gpu"):
+        # onnxruntime-directml (Windows) / CoreML (macOS builds)
+        for provider in GPU_FALLBACK_PROVIDERS:
+            if provider in available:
+                return [provider, "CPUExecutionProvider"]
+    if SINATRA_DEVICE in ("cuda", "gpu", "fp16"):
+        print(f"⚠️  SINATRA_DEVICE={SINATRA_DEVICE} but CUDAExecutionProvider is unavailable, using CPU")
+    return ["CPUExecutionProvider"]
 
 
-def _snap_to_scale(pitch: int, valid_notes: set[int]) -> int:
-    """Snap a MIDI pitch to the nearest note in the scale."""
-    if pitch in valid_notes:
-        return pitch
-    # Search up and down for the closest valid note
-    for offset in range(1, 7):
-        if (pitch + offset) in valid_notes:
-            return pitch + offset
-        if (pitch - offset) in valid_notes:
-            return pitch - offset
-    return pitch  # Fallback (shouldn't happen with chromatic)
+def _session_options() -> "ort.SessionOptions":
+    """
+    Options for the one long-lived Basic Pitch session: every graph optimization,
+    and sequential execution (a plain CNN has no parallel branches to exploit).
+    """
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = ORT_THREADS
+    return options
+
+
+def _cpu_tag() -> str:
+    """Short hash of the CPU architecture, model and instruction-set flags."""
+    parts = [platform.machine(), platform.processor()]
+    try:
+        # First core's entries are enough: x86 "flags"/"model name", ARM "Features"/"CPU part"
+        seen = set()
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                name = name.strip()
+                if name in ("flags", "Features", "model name", "CPU part") and name not in seen:
+                    seen.add(name)
+                    parts.append(value.strip())
+    except OSError:
+        pass
+    return hashlib.blake2b("\0".join(parts).encode(), digest_size=6).hexdigest()
+
+
+def _optimized_session(model_path: str) -> "ort.InferenceSession":
+    """
+    CPU session for model_path, reusing a graph-optimized copy saved by an
+    earlier start instead of re-running every optimization pass. The copy is
+    specific to the ONNX Runtime version, execution providers and CPU it was
+    made with, so all three are part of its name.
+    """
+    providers = ["CPUExecutionProvider"]
+    provider_tag = "-".join(p.removesuffix("ExecutionProvider").lower() for p in providers)
+    stem = os.path.basename(model_path).replace(".onnx", "")
+    opt_path = os.path.join(
+        MODEL_CACHE_DIR, f"{stem}.ort-{ort.__version__}.{provider_tag}.{_cpu_tag()}.opt.onnx"
+    )
+    options = _session_options()
+    if os.path.exists(opt_path):
+        try:
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            return ort.InferenceSession(opt_path, sess_options=options, providers=providers)
+        except Exception as e:
+            print(f"⚠️  Optimized model cache unusable ({e}), rebuilding it")
+            options = _session_options()
+    try:
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        tmp_path = opt_path + ".tmp"
+        options.optimized_model_filepath = tmp_path
+        session = ort.InferenceSession(model_path, sess_options=options, providers=providers)
+        os.replace(tmp_path, opt_path)
+        return session
+    except Exception as e:
+        print(f"⚠️  Could not cache the optimized model ({e})")
+        return ort.InferenceSession(model_path, sess_options=_session_options(), providers=providers)
+
+
+def _int8_model_path(model_path: str) -> str:
+    """
+    Quantize the model's weights to INT8 once and cache the result on disk.
+    Falls back to the float model if quantization isn't possible here.
+    """
+    int8_path = os.path.join(MODEL_CACHE_DIR, os.path.basename(model_path).replace(".onnx", ".int8.onnx"))
+    if os.path.exists(int8_path):
+        return int8_path
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        tmp_path = int8_path + ".tmp"
+        quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QUInt8)
+        os.replace(tmp_path, int8_path)
+        return int8_path
+    except Exception as e:
+        print(f"⚠️  INT8 quantization unavailable ({e}), using the float model")
+        return model_path
+
+
+def _fp16_model_path(model_path: str) -> str:
+    """
+    Convert the model's weights and activations to float16 once and cache the
+    result on disk. Inputs and outputs stay float32, so the audio windows fed in
+    and the activations read back are unchanged. Falls back to the float model
+    if conversion isn't possible here.
+    """
+    fp16_path = os.path.join(MODEL_CACHE_DIR, os.path.basename(model_path).replace(".onnx", ".fp16.onnx"))
+    if os.path.exists(fp16_path):
+        return fp16_path
+    try:
+        import onnx
+        from onnxconverter_common import float16
+
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        tmp_path = fp16_path + ".tmp"
+        onnx.save(float16.convert_float_to_float16(onnx.load(model_path), keep_io_types=True), tmp_path)
+        os.replace(tmp_path, fp16_path)
+        return fp16_path
+    except Exception as e:
+        print(f"⚠️  FP16 conversion unavailable ({e}), using the float model")
+        return model_path
+
+
+@lru_cache(maxsize=1)
+def _load_model() -> Model:
+    """
+    Load the Basic Pitch model once and keep it for the lifetime of the process.
+    Passing a path to predict() would rebuild the inference session on every call.
+    """
+    model_path = str(ICASSP_2022_MODEL_PATH)
+    if ort is None or not model_path.endswith(".onnx"):
+        return Model(model_path)
+
+    providers = _select_providers()
+    if SINATRA_DEVICE == "int8" and providers == ["CPUExecutionProvider"]:
+        model_path = _int8_model_path(model_path)
+    elif SINATRA_DEVICE == "fp16" and providers[0] == "CUDAExecutionProvider":
+        # Half precision only pays off on GPU; ONNX Runtime's CPU kernels are float32
+        model_path = _fp16_model_path(model_path)
+
+    # Model() would build its own CPU-only session with default options, only for
+    # it to be replaced; wrap the session for the chosen providers directly.
+    # Only the batcher thread ever runs it, so no lock.
+    if providers == ["CPUExecutionProvider"]:
+        session = _optimized_session(model_path)
+    else:
+        session = ort.InferenceSession(model_path, sess_options=_session_options(), providers=providers)
+    model = Model.__new__(Model)
+    model.model_type = Model.MODEL_TYPES.ONNX
+    model.model = session
+    print(f"🤖 Basic Pitch on {providers[0]} ({os.path.basename(model_path)})")
+    return model
+
+
+class InferenceBatcher:
+    """
+    Single thread in front of the Basic Pitch session. Transcriptions submit
+    their audio windows; everything that arrives within the linger time is
+    stacked into one model run (of at most max_windows windows) and the
+    outputs are split back per caller.
+    """
+
+    def __init__(self, linger_sec: float = BATCH_LINGER_SEC, max_windows: int = MAX_BATCH_WINDOWS):
+        self._linger_sec = linger_sec
+        self._max_windows = max_windows
+        self._queue: queue.Queue = queue.Queue()
+        # Reused input for every session run (grown if a batch ever needs more)
+        self._input_buffer: np.ndarray | None = None
+        # Set if the thread died (e.g. the model failed to load); fails all submissions
+        self.error: BaseException | None = None
+        self._thread = threading.Thread(target=self._run, name="basic-pitch-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, windows: np.ndarray) -> Future:
+        """Queue (n_windows, AUDIO_N_SAMPLES, 1) audio; resolves to {note, onset, contour}."""
+        future: Future = Future()
+        self._queue.put((windows, future))
+        if self.error is not None:
+            self._fail_pending()
+        return future
+
+    def _fail_pending(self) -> None:
+        """Hand self.error to everything still queued."""
+        while True:
+            try:
+                _, future = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if future.set_running_or_notify_cancel():
+                future.set_exception(self.error)
+
+    def _run(self) -> None:
+        try:
+            self._serve(_load_model())
+        except BaseException as e:
+            print(f"❌ Basic Pitch batcher stopped: {e}")
+            self.error = e
+            self._fail_pending()
+
+    @property
+    def max_windows(self) -> int:
+        return self._max_windows
+
+    def _serve(self, model: Model) -> None:
+        carry = None  # Submission that would have pushed the last batch past max_windows
+        while True:
+            batch = [carry if carry is not None else self._queue.get()]
+            carry = None
+            total = len(batch[0][0])
+            deadline = time.monotonic() + self._linger_sec
+            while total < self._max_windows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if total + len(item[0]) > self._max_windows:
+                    carry = item
+                    break
+                batch.append(item)
+                total += len(item[0])
+            self._dispatch(model, batch)
+
+    def _predict_windows(self, model: Model, windows: list[np.ndarray]) -> dict:
+        """
+        Run the model on several callers' windows as one batch. ONNX sessions are
+        fed through an IOBinding on a preallocated input buffer, so there is no
+        per-run input allocation; other backends go through Model.predict.
+        """
+        session = model.model
+        if ort is None or not isinstance(session, ort.InferenceSession):
+            return model.predict(np.concatenate(windows))
+
+        total = sum(len(w) for w in windows)
+        if self._input_buffer is None or len(self._input_buffer) < total:
+            shape = (max(total, self._max_windows),) + windows[0].shape[1:]
+            self._input_buffer = np.empty(shape, dtype=np.float32)
+        batch_input = self._input_buffer[:total]
+        np.concatenate(windows, out=batch_input)
+
+        binding = session.io_binding()
+        binding.bind_cpu_input(ONNX_INPUT_NAME, batch_input)
+        for name in ONNX_OUTPUT_NAMES.values():
+            binding.bind_output(name)
+        session.run_with_iobinding(binding)
+        return dict(zip(ONNX_OUTPUT_NAMES, binding.copy_outputs_to_cpu()))
+
+    def _dispatch(self, model: Model, batch: list) -> None:
+        batch = [(windows, future) for windows, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            outputs = self._predict_windows(model, [windows for windows, _ in batch])
+        except BaseException as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        offset = 0
+        for windows, future in batch:
+            n = len(windows)
+            future.set_result({k: v[offset:offset + n] for k, v in outputs.items()})
+            offset += n
+
+
+_batcher: InferenceBatcher | None = None
+_batcher_lock = threading.Lock()
+
+
+def _get_batcher() -> InferenceBatcher:
+    """The shared batcher, replaced by a fresh one (retrying the model load) if it has died."""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None or _batcher.error is not None:
+            _batcher = InferenceBatcher()
+        return _batcher
+
+
+def run_model(audio_path: str) -> dict:
+    """
+    Basic Pitch's note/onset/contour activations for a file. Independent of tempo
+    and of all note-creation settings, so callers can start it before the BPM is known.
+    """
+    print(f"Predicting MIDI for {audio_path}...")
+    windows = []
+    original_length = 0
+    for window, _, original_length in get_audio_input(audio_path, OVERLAP_LEN, HOP_SIZE):
+        windows.append(window)
+    windows = np.concatenate(windows)
+    # Submit long takes in pieces of at most max_windows, so no session run
+    # (and its activation memory) grows with the length of the recording
+    batcher = _get_batcher()
+    step = batcher.max_windows
+    futures = [batcher.submit(windows[i:i + step]) for i in range(0, len(windows), step)]
+    parts = [future.result(timeout=BATCH_RESULT_TIMEOUT_SEC) for future in futures]
+    return {
+        k: unwrap_output(np.concatenate([part[k] for part in parts]), original_length, N_OVERLAPPING_FRAMES)
+        for k in parts[0]
+    }
+
+
+def _predict(
+    audio_path: str,
+    onset_threshold: float = 0.5,
+    frame_threshold: float = 0.3,
+    minimum_note_length: float = 127.70,
+    minimum_frequency: float | None = None,
+    maximum_frequency: float | None = None,
+    melodia_trick: bool = True,
+    midi_tempo: float = 120,
+    model_output: dict | None = None,
+):
+    """
+    basic_pitch.inference.predict(), but with all of the file's windows sent
+    through the shared batcher instead of one session run per window.
+    Pass model_output from run_model() to skip inference.
+    """
+    if model_output is None:
+        model_output = run_model(audio_path)
+
+    min_note_len = int(np.round(minimum_note_length / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)))
+    midi_data, note_events = infer.model_output_to_notes(
+        model_output,
+        onset_thresh=onset_threshold,
+        frame_thresh=frame_threshold,
+        min_note_len=min_note_len,
+        min_freq=minimum_frequency,
+        max_freq=maximum_frequency,
+        melodia_trick=melodia_trick,
+        midi_tempo=midi_tempo,
+    )
+    return model_output, midi_data, note_events
 
 
-def _quantize_time(t: float, bpm: float, quantize: str) -> float:
+def warm_up() -> None:
+    """
+    Load the model and run one inference on a second of silence so the first
+    real transcription doesn't pay for model loading and first-run setup.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp:
+        silence_path = tmp.name
+    try:
+        sf.write(silence_path, np.zeros(22050, dtype=np.float32), 22050)
+        # Note creation divides by the peak activation, which is zero for silence
+        with np.errstate(invalid="ignore", divide="ignore"):
+            _predict(silence_path)
+    finally:
+        os.remove(silence_path)
+
+
+@lru_cache(maxsize=64)
+def _build_snap_table(key: str, scale: str) -> np.ndarray:
     """
-    Quantize a time value (seconds) to the nearest grid division.
-    quantize: "1/4", "1/8", "1/16", "1/32", or "off"
+    For every MIDI note 0-127, the nearest note of the key+scale (searching up
+    before down at equal distance), so snapping a pitch is one array lookup.
+    """
+    root = KEY_OFFSETS.get(key, 0)
+    intervals = SCALE_INTERVALS.get(scale, SCALE_INTERVALS["chromatic"])
+    pitch_classes = set((root + i) % 12 for i in intervals)
+    valid = [midi % 12 in pitch_classes for midi in range(128)]
+
+    table = np.arange(128, dtype=np.int64)
+    for pitch in range(128):
+        if valid[pitch]:
+            continue
+        for offset in range(1, 7):
+            if pitch + offset < 128 and valid[pitch + offset]:
+                table[pitch] = pitch + offset
+                break
+            if pitch - offset >= 0 and valid[pitch - offset]:
+                table[pitch] = pitch - offset
+                break
+    table.flags.writeable = False  # shared between calls through the cache
+    return table
+
+
+def _grid_size(bpm: float, quantize: str) -> float | None:
+    """
+    Duration in seconds of one grid cell for quantize ("1/4", "1/8", "1/16",
+    "1/32"), or None for "off".
     """
     if quantize == "off":
-        return t
+        return None
+    subdivisions_per_beat = QUANTIZE_DIVISIONS.get(quantize, 1)
+    return 60.0 / bpm / subdivisions_per_beat
 
-    divisions = {"1/4": 1, "1/8": 2, "1/16": 4, "1/32": 8}
-    subdivisions_per_beat = divisions.get(quantize, 1)
 
-    # Duration of one grid cell in seconds
-    beat_duration = 60.0 / bpm
-    grid_size = beat_duration / subdivisions_per_beat
-
-    # Snap to nearest grid line
-    return round(t / grid_size) * grid_size
+def _clean_notes(notes: list, snap_table: np.ndarray | None = None, grid: float | None = None) -> list:
+    """
+    Post-process one instrument's raw notes on parallel arrays, creating Note
+    objects only for the survivors:
+    round pitches, drop short/quiet notes, sort by start, merge same-pitch
+    stutters, cap the note density, then snap to the scale of snap_table (from
+    _build_snap_table) and to a time grid of `grid` seconds, if given.
+    """
+    count = len(notes)
+    starts = np.fromiter((n.start for n in notes), dtype=np.float64, count=count)
+    ends = np.fromiter((n.end for n in notes), dtype=np.float64, count=count)
+    pitches = np.fromiter((n.pitch for n in notes), dtype=np.float64, count=count)
+    velocities = np.fromiter((n.velocity for n in notes), dtype=np.int64, count=count)
+
+    # Round pitches to nearest MIDI note
+    pitches = np.round(np.clip(pitches, 0, 127)).astype(np.int64)
+
+    # Drop short notes and quiet notes, then sort by start time
+    keep = np.flatnonzero((ends - starts >= MIN_NOTE_DURATION_SEC) & (velocities >= MIN_VELOCITY))
+    keep = keep[np.argsort(starts[keep], kind="stable")]
+    starts, ends, pitches, velocities = starts[keep], ends[keep], pitches[keep], velocities[keep]
+    if not len(starts):
+        return []
+
+    # Merge consecutive same-pitch notes with tiny gaps. Within a run of equal
+    # pitches the merged note ends at the running max end; offsetting each run
+    # by more than any time lets one cumulative max serve all runs.
+    new_run = np.empty(len(starts), dtype=bool)
+    new_run[0] = True
+    new_run[1:] = pitches[1:] != pitches[:-1]
+    run_offset = np.cumsum(new_run) * (ends.max() + 1.0)
+    running_end = np.maximum.accumulate(ends + run_offset) - run_offset
+    new_note = new_run.copy()
+    new_note[1:] |= (starts[1:] - running_end[:-1]) >= MERGE_GAP_SEC
+    firsts = np.flatnonzero(new_note)
+    starts, pitches = starts[firsts], pitches[firsts]
+    ends = np.maximum.reduceat(ends, firsts)
+    velocities = np.maximum.reduceat(velocities, firsts)
+
+    # Limit note density — if too many notes in a short window, keep the loudest
+    duration = ends[-1] - starts[0]
+    if duration > 0 and len(starts) / duration > MAX_NOTES_PER_SECOND:
+        # Bucket into 0.25s windows (each opened by the first note past the
+        # previous one), keep top notes per window
+        max_per_window = max(2, int(MAX_NOTES_PER_SECOND * 0.25))
+        window_firsts = [0]
+        window_start = starts[0]
+        for i, start in enumerate(starts.tolist()):
+            if start >= window_start + 0.25:
+                window_firsts.append(i)
+                window_start = start
+        # One stable sort by (window, loudest first); a note's rank in its
+        # window is its position minus where the window begins in that order
+        window_ids = np.zeros(len(starts), dtype=np.int64)
+        window_ids[window_firsts[1:]] = 1
+        window_ids = np.cumsum(window_ids)
+        order = np.lexsort((-velocities, window_ids))
+        ranks = np.arange(len(order)) - np.asarray(window_firsts)[window_ids[order]]
+        kept = order[ranks < max_per_window]
+        kept = kept[np.argsort(starts[kept], kind="stable")]
+        starts, ends, pitches, velocities = starts[kept], ends[kept], pitches[kept], velocities[kept]
+
+    if snap_table is not None:
+        pitches = snap_table[pitches]
+
+    if grid is not None:
+        # Snap to nearest grid line; notes quantized to nothing get one grid cell
+        starts = np.round(starts / grid) * grid
+        ends = np.round(ends / grid) * grid
+        ends = np.where(ends <= starts, starts + grid, ends)
+
+    return [
+        pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end)
+        for velocity, pitch, start, end in zip(
+            velocities.tolist(), pitches.tolist(), starts.tolist(), ends.tolist()
+        )
+    ]
 
 
 def vocal_to_midi(
@@ -105,6 +585,7 @@ def vocal_to_midi(
     key: str = "C",
     scale: str = "chromatic",
     quantize: str = "off",
+    model_output: dict | None = None,
 ) -> str:
     """
     Convert a vocal WAV recording to MIDI using Spotify's Basic Pitch.
@@ -116,6 +597,7 @@ def vocal_to_midi(
         key:       Musical key root note (e.g. "C", "F#", "Bb").
         scale:     Scale type: "major", "minor", or "chromatic".
         quantize:  Note quantization: "off", "1/4", "1/8", "1/16", "1/32".
+        model_output: Activations from run_model(wav_path), if already computed.
     """
     print("=" * 60)
     print("🎵 USING SPOTIFY BASIC PITCH (ML MODEL) 🎵")
@@ -128,10 +610,9 @@ def vocal_to_midi(
     print(f"🤖 Model: {ICASSP_2022_MODEL_PATH}")
     print("=" * 60)
 
-    # Run Basic Pitch inference (uses ONNX model automatically)
-    model_output, midi_data, note_events = predict(
-        audio_path=wav_path,
-        model_or_model_path=ICASSP_2022_MODEL_PATH,
+    # Run Basic Pitch inference (batched with any concurrent transcriptions)
+    model_output, midi_data, note_events = _predict(
+        wav_path,
         onset_threshold=ONSET_THRESHOLD,
         frame_threshold=FRAME_THRESHOLD,
         minimum_note_length=MIN_NOTE_LENGTH_MS,
@@ -139,94 +620,26 @@ def vocal_to_midi(
         maximum_frequency=MAX_FREQ_HZ,
         melodia_trick=True,
         midi_tempo=bpm,
+        model_output=model_output,
     )
 
     raw_notes = sum(len(inst.notes) for inst in midi_data.instruments)
     print(f"   Raw notes from Basic Pitch: {raw_notes}")
 
     # ---- Post-processing for each instrument ----
+    snap_table = _build_snap_table(key, scale) if scale != "chromatic" else None
+    grid = _grid_size(bpm, quantize)
     for inst in midi_data.instruments:
         # 1. Strip pitch bends — snap to exact semitones
         inst.pitch_bends = []
 
-        # 2. Round pitches to nearest MIDI note
-        for note in inst.notes:
-            note.pitch = int(round(max(0, min(127, note.pitch))))
-
-        # 3. Drop short notes and quiet notes
-        inst.notes = [
-            n for n in inst.notes
-            if (n.end - n.start) >= MIN_NOTE_DURATION_SEC
-            and n.velocity >= MIN_VELOCITY
-        ]
-
-        # 4. Sort by start time
-        inst.notes.sort(key=lambda n: n.start)
-
-        # 5. Merge consecutive same-pitch notes with tiny gaps
-        merged = []
-        for note in inst.notes:
-            if (
-                merged
-                and note.pitch == merged[-1].pitch
-                and (note.start - merged[-1].end) < MERGE_GAP_SEC
-            ):
-                # Extend the previous note
-                merged[-1].end = max(merged[-1].end, note.end)
-                merged[-1].velocity = max(merged[-1].velocity, note.velocity)
-            else:
-                merged.append(note)
-        inst.notes = merged
-
-        # 6. Limit note density — if too many notes in a short window, keep the loudest
-        if inst.notes:
-            duration = inst.notes[-1].end - inst.notes[0].start
-            if duration > 0:
-                notes_per_sec = len(inst.notes) / duration
-                if notes_per_sec > MAX_NOTES_PER_SECOND:
-                    # Bucket into 0.25s windows, keep top notes per window
-                    max_per_window = max(2, int(MAX_NOTES_PER_SECOND * 0.25))
-                    filtered = []
-                    window_start = inst.notes[0].start
-                    window_notes = []
-
-                    for note in inst.notes:
-                        if note.start >= window_start + 0.25:
-                            # Flush window: keep loudest notes
-                            window_notes.sort(key=lambda n: n.velocity, reverse=True)
-                            filtered.extend(window_notes[:max_per_window])
-                            window_start = note.start
-                            window_notes = [note]
-                        else:
-                            window_notes.append(note)
-
-                    # Flush last window
-                    window_notes.sort(key=lambda n: n.velocity, reverse=True)
-                    filtered.extend(window_notes[:max_per_window])
-
-                    filtered.sort(key=lambda n: n.start)
-                    inst.notes = filtered
-
-    # ---- Scale snapping ----
-    if scale != "chromatic":
-        valid_notes = _build_scale_set(key, scale)
-        for inst in midi_data.instruments:
-            for note in inst.notes:
-                note.pitch = _snap_to_scale(note.pitch, valid_notes)
+        # 2-8. Round, filter, sort, merge, thin out, scale-snap and quantize the notes
+        inst.notes = _clean_notes(inst.notes, snap_table, grid)
+
+    if snap_table is not None:
         print(f"🎼 Snapped notes to {key} {scale}")
 
-    # ---- Time quantization ----
-    if quantize != "off":
-        for inst in midi_data.instruments:
-            for note in inst.notes:
-                q_start = _quantize_time(note.start, bpm, quantize)
-                q_end = _quantize_time(note.end, bpm, quantize)
-                # Ensure note has minimum duration after quantization
-                if q_end <= q_start:
-                    grid = 60.0 / bpm / {"1/4": 1, "1/8": 2, "1/16": 4, "1/32": 8}.get(quantize, 1)
-                    q_end = q_start + grid
-                note.start = q_start
-                note.end = q_end
+    if grid is not None:
         print(f"⏱️  Quantized notes to {quantize} grid")
 
     final_notes = sum(len(inst.notes) for inst in midi_data.instruments)
@@ -4,4 +4,4 @@
 
 PORT=${PORT:-8000}
 echo "Starting Sinatra backend on port $PORT"
-uvicorn main:app --host 0.0.0.0 --port $PORT
+uvicorn main:app --host 0.0.0.0 --port $PORT --loop uvloop --http httptools --timeout-keep-alive 65
@@ -0,0 +1,22 @@
+import pytest
+
+from services.chords import parse_chord
+
+
+@pytest.mark.parametrize("symbol", ["E#", "B#", "E#m7", "B#maj7"])
+def test_unmapped_root_is_a_value_error(symbol):
+    # generate_chord_progression skips chords that raise ValueError
+    with pytest.raises(ValueError, match="Unknown root note"):
+        parse_chord(symbol)
+
+
+@pytest.mark.parametrize("symbol", ["H", "xm7", "#"])
+def test_unknown_root_is_a_value_error(symbol):
+    with pytest.raises(ValueError, match="Unknown root note"):
+        parse_chord(symbol)
+
+
+def test_known_chords_still_parse():
+    assert parse_chord("Cmaj7") == (60, 64, 67, 71)
+    assert parse_chord("F#dim") == (66, 69, 72)
+    assert parse_chord("Cb") == (71, 75, 78)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import soundfile as sf
+
+transcription = pytest.importorskip("services.transcription")
+from basic_pitch import ICASSP_2022_MODEL_PATH
+from basic_pitch.inference import predict
+
+
+@pytest.fixture
+def clip(tmp_path):
+    # Six seconds of sine rising a semitone per second: four model windows
+    sr = 22050
+    t = np.arange(6 * sr) / sr
+    freqs = 220 * 2 ** (np.floor(t) / 12)
+    path = tmp_path / "clip.wav"
+    sf.write(path, (0.5 * np.sin(2 * np.pi * np.cumsum(freqs) / sr)).astype(np.float32), sr)
+    return str(path)
+
+
+@pytest.fixture
+def small_batcher(monkeypatch):
+    # Two windows per session run, so the clip is split across several runs
+    batcher = transcription.InferenceBatcher(max_windows=2)
+    monkeypatch.setattr(transcription, "_batcher", batcher)
+    return batcher
+
+
+def test_run_model_matches_basic_pitch_predict(clip, small_batcher):
+    expected, _, _ = predict(clip, ICASSP_2022_MODEL_PATH)
+    actual = transcription.run_model(clip)
+    assert actual.keys() == expected.keys()
+    for key in expected:
+        np.testing.assert_allclose(actual[key], expected[key], atol=1e-5)
+
+
+def test_session_runs_stay_within_max_windows(clip, small_batcher, monkeypatch):
+    sizes = []
+    predict_windows = small_batcher._predict_windows
+
+    def recording(model, windows):
+        sizes.append(sum(len(w) for w in windows))
+        return predict_windows(model, windows)
+
+    monkeypatch.setattr(small_batcher, "_predict_windows", recording)
+    transcription.run_model(clip)
+    assert len(sizes) > 1
+    assert max(sizes) <= small_batcher.max_windows
@@ -1,6 +1,9 @@
+import hashlib
 import os
-import uuid
-import wave
+import shutil
+import threading
+
+import aiofiles
 
 # Directory for temporary uploads and generated files
 UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
@@ -9,27 +12,79 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 def generate_filepath(extension: str = "wav") -> str:
     """Generate a unique file path in the uploads directory."""
-    filename = f"{uuid.uuid4().hex}.{extension}"
+    filename = f"{os.urandom(16).hex()}.{extension}"
     return os.path.join(UPLOAD_DIR, filename)
 
 
+# RIFF chunk descriptor: b"RIFF" + 4-byte size + b"WAVE"
+RIFF_HEADER_SIZE = 12
+# Each sub-chunk starts with a 4-byte id and a 4-byte little-endian size
+CHUNK_HEADER_SIZE = 8
+# The fmt chunk need not come first (JUNK/bext/LIST chunks in broadcast WAVs),
+# so skip over a few chunks by seeking -- never by reading their bodies
+MAX_CHUNKS_BEFORE_FMT = 16
+
+
 def validate_wav(file_path: str) -> bool:
-    """Quick check that a file is a valid WAV."""
+    """
+    Quick check that a file is a WAV: the RIFF/WAVE header plus a plausible fmt
+    chunk (format code, channels, sample rate). Reads a few dozen bytes at most;
+    a malformed body is caught later by the decoder anyway.
+    """
     try:
-        with wave.open(file_path, "rb") as wf:
-            wf.getparams()
-        return True
-    except Exception:
+        with open(file_path, "rb") as f:
+            header = f.read(RIFF_HEADER_SIZE)
+            if len(header) != RIFF_HEADER_SIZE or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+                return False
+            for _ in range(MAX_CHUNKS_BEFORE_FMT):
+                chunk = f.read(CHUNK_HEADER_SIZE)
+                if len(chunk) != CHUNK_HEADER_SIZE:
+                    return False
+                chunk_id, chunk_size = chunk[:4], int.from_bytes(chunk[4:], "little")
+                if chunk_id == b"fmt ":
+                    fmt = f.read(16)
+                    if chunk_size < 16 or len(fmt) != 16:
+                        return False
+                    format_code = int.from_bytes(fmt[0:2], "little")
+                    channels = int.from_bytes(fmt[2:4], "little")
+                    sample_rate = int.from_bytes(fmt[4:8], "little")
+                    return format_code != 0 and channels > 0 and sample_rate > 0
+                if chunk_id == b"data":
+                    return False  # fmt must precede the sample data
+                # Chunks are word-aligned: odd sizes carry one pad byte
+                f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+    except OSError:
         return False
+    return False
+
+
+# Size of each read when copying an upload to disk
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
 
 
-async def save_upload(upload_file, extension: str = "wav") -> str:
-    """Save an uploaded file to disk and return the path."""
+async def save_upload_hashed(upload_file, extension: str = "wav") -> tuple[str, str]:
+    """
+    Stream an uploaded file to disk in chunks. Returns the path and a BLAKE2b
+    digest of the content, computed on the chunks as they stream past, so
+    re-uploads of the same file can be recognised.
+    """
     file_path = generate_filepath(extension)
-    contents = await upload_file.read()
-    with open(file_path, "wb") as f:
-        f.write(contents)
-    return file_path
+    # Streamed under a scratch name and renamed when complete, so nothing
+    # (static file serving, validation, cleanup) ever sees a half-written upload
+    part_path = file_path + ".part"
+    h = hashlib.blake2b(digest_size=16)
+    # aiofiles runs each write in a thread, so slow disks don't stall the event loop
+    try:
+        async with aiofiles.open(part_path, "wb") as f:
+            while chunk := await upload_file.read(UPLOAD_CHUNK_SIZE):
+                h.update(chunk)
+                await f.write(chunk)
+        os.replace(part_path, file_path)
+    except BaseException:
+        # Client went away or the disk filled up mid-stream: don't leave a partial file
+        cleanup_file(part_path)
+        raise
+    return file_path, h.hexdigest()
 
 
 def cleanup_file(file_path: str) -> None:
@@ -39,3 +94,85 @@ def cleanup_file(file_path: str) -> None:
             os.remove(file_path)
     except OSError:
         pass
+
+
+# Rendered WAVs, keyed by MIDI content + render settings. Least recently used go first.
+RENDER_CACHE_DIR = os.path.join(UPLOAD_DIR, "cache")
+RENDER_CACHE_MAX_FILES = 64
+# Hashed into every cache key. Bump it whenever a renderer (FluidSynth, sampler,
+# preview downmix) starts producing different audio, so stale entries miss.
+RENDER_CACHE_VERSION = 2
+os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+
+
+def render_cache_path(midi_path: str | bytes, *key: str) -> str:
+    """Return the cache location for rendering this MIDI file (path or bytes) with these settings."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"v{RENDER_CACHE_VERSION}\0".encode())
+    if isinstance(midi_path, bytes):
+        h.update(midi_path)
+    else:
+        with open(midi_path, "rb") as f:
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                h.update(chunk)
+    for part in key:
+        h.update(b"\0" + part.encode())
+    return os.path.join(RENDER_CACHE_DIR, f"{h.hexdigest()}.wav")
+
+
+# Serializes cache writes and eviction sweeps across pipeline threads
+_cache_lock = threading.Lock()
+
+
+def _link(src: str, dst: str) -> None:
+    """Hard-link src to dst, copying where the filesystem has no hard links."""
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def cache_fetch(cache_path: str) -> str | None:
+    """
+    On a cache hit, mark the entry as recently used and return a fresh uploads
+    path linked to it (None on a miss). The link stays valid after the entry
+    itself is evicted, so callers can serve it or keep it in a session.
+    """
+    with _cache_lock:
+        try:
+            os.utime(cache_path)
+            out_path = generate_filepath(os.path.splitext(cache_path)[1].lstrip("."))
+            _link(cache_path, out_path)
+        except FileNotFoundError:
+            return None
+    return out_path
+
+
+def _evict_cache() -> None:
+    """Drop the least recently used entries beyond RENDER_CACHE_MAX_FILES."""
+    entries = []
+    for entry in os.scandir(RENDER_CACHE_DIR):
+        try:
+            if entry.is_file():
+                entries.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            continue  # already removed by another worker's sweep
+    entries.sort(reverse=True)
+    for _, path in entries[RENDER_CACHE_MAX_FILES:]:
+        cleanup_file(path)
+
+
+def cache_store(wav_path: str, cache_path: str) -> str:
+    """
+    Add a fresh render to the cache (as a second link to it) and evict the
+    oldest entries. Returns wav_path, which eviction never touches.
+    """
+    part_path = cache_path + ".part"
+    with _cache_lock:
+        cleanup_file(part_path)
+        _link(wav_path, part_path)
+        os.replace(part_path, cache_path)
+        _evict_cache()
+    return wav_path
@@ -0,0 +1,93 @@
+"""
+gzip for JSON/text responses only.
+
+Starlette's GZipMiddleware decides per response as well, but which types it
+skips depends on the installed version. Here the rule is explicit: JSON and
+text bodies are compressed; audio, MIDI, octet-streams and Server-Sent Events
+(which must reach the client unbuffered) are passed through untouched.
+"""
+
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+NEVER_COMPRESS_TYPES = ("text/event-stream",)
+
+
+def _compressible(content_type: str) -> bool:
+    content_type = content_type.split(";", 1)[0].strip().lower()
+    if content_type.startswith(NEVER_COMPRESS_TYPES):
+        return False
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class JSONGZipMiddleware:
+    def __init__(self, app, minimum_size: int = 512, compresslevel: int = 6):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accepts_gzip = "gzip" in Headers(scope=scope).get("accept-encoding", "")
+
+        start_message = None
+        passthrough = False
+        compressor = None
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough, compressor
+
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                if "content-encoding" in headers or not _compressible(headers.get("content-type", "")):
+                    passthrough = True
+                    await send(message)
+                    return
+                # Whether this response is compressed depends on Accept-Encoding (and
+                # its size), so caches must key on it even when it goes out plain
+                headers.add_vary_header("Accept-Encoding")
+                if not accepts_gzip:
+                    passthrough = True
+                    await send(message)
+                else:
+                    # Hold the headers until we know whether the body is worth compressing
+                    start_message = message
+                return
+
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if compressor is None:
+                if not more_body and len(body) < self.minimum_size:
+                    await send(start_message)
+                    await send(message)
+                    return
+                # wbits=31: zlib stream in a gzip container
+                compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, 31)
+                data = compressor.compress(body)
+                if not more_body:
+                    data += compressor.flush()
+                headers = MutableHeaders(raw=start_message["headers"])
+                headers["Content-Encoding"] = "gzip"
+                if more_body:
+                    del headers["Content-Length"]
+                else:
+                    headers["Content-Length"] = str(len(data))
+                await send(start_message)
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+                return
+
+            data = compressor.compress(body)
+            if not more_body:
+                data += compressor.flush()
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
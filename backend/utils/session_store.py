@@ -0,0 +1,158 @@
+"""
+SQLite-backed storage for per-client session metadata (latest upload/render paths)
+and for analysis results of uploads, keyed by content digest.
+
+WAL mode lets several uvicorn workers share one database file: readers never
+block the writer, and each update is a single small transaction.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+# Kept next to (not inside) the uploads dir, which is served publicly
+SESSION_DB_PATH = os.environ.get(
+    "SESSION_DB_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "sessions.db"),
+)
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SessionStore:
+    """
+    Key/value rows per session: (sid, key) → value (TEXT, REAL or NULL), plus
+    the time each session was last written, so idle sessions can be expired.
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS session ("
+            " sid TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value,"
+            " PRIMARY KEY (sid, key))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_activity ("
+            " sid TEXT PRIMARY KEY,"
+            " used REAL NOT NULL)"
+        )
+        # Sessions written before activity was tracked count as used now
+        self._conn.execute(
+            "INSERT OR IGNORE INTO session_activity (sid, used) SELECT DISTINCT sid, ? FROM session",
+            (time.time(),),
+        )
+
+    def load(self, sid: str) -> dict:
+        """Return every stored field for a session (empty if it has none yet)."""
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM session WHERE sid = ?", (sid,)).fetchall()
+        return dict(rows)
+
+    def save(self, sid: str, changes: dict) -> dict:
+        """Upsert several fields of a session in one transaction; returns all of its fields."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO session (sid, key, value) VALUES (?, ?, ?)"
+                    " ON CONFLICT (sid, key) DO UPDATE SET value = excluded.value",
+                    [(sid, key, value) for key, value in changes.items()],
+                )
+                self._conn.execute(
+                    "INSERT INTO session_activity (sid, used) VALUES (?, ?)"
+                    " ON CONFLICT (sid) DO UPDATE SET used = excluded.used",
+                    (sid, time.time()),
+                )
+                rows = self._conn.execute("SELECT key, value FROM session WHERE sid = ?", (sid,)).fetchall()
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return dict(rows)
+
+    def referenced_values(self) -> set:
+        """Every TEXT value stored in any session (file paths among them)."""
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT value FROM session WHERE typeof(value) = 'text'").fetchall()
+        return {value for (value,) in rows}
+
+    def expire(self, max_age_sec: float) -> int:
+        """Delete sessions not written for max_age_sec; returns how many went."""
+        cutoff = time.time() - max_age_sec
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM session WHERE sid IN (SELECT sid FROM session_activity WHERE used < ?)",
+                    (cutoff,),
+                )
+                expired = self._conn.execute("DELETE FROM session_activity WHERE used < ?", (cutoff,)).rowcount
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return expired
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class AnalysisStore:
+    """
+    Bounded key → value table (REAL or BLOB) for BPM, pitch and transcription
+    results, so repeated uploads skip analysis across restarts and workers.
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH, max_entries: int = 512):
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._conn = _connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis ("
+            " key TEXT PRIMARY KEY,"
+            " value,"
+            " used REAL NOT NULL)"
+        )
+
+    def get(self, key: str):
+        """Return the stored value (None on a miss), marking it as recently used."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM analysis WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE analysis SET used = ? WHERE key = ?", (time.time(), key))
+        return None if row is None else row[0]
+
+    def put(self, key: str, value) -> None:
+        """Store a value, dropping the least recently used rows beyond max_entries."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO analysis (key, value, used) VALUES (?, ?, ?)"
+                    " ON CONFLICT (key) DO UPDATE SET value = excluded.value, used = excluded.used",
+                    (key, value, time.time()),
+                )
+                self._conn.execute(
+                    "DELETE FROM analysis WHERE key NOT IN"
+                    " (SELECT key FROM analysis ORDER BY used DESC LIMIT ?)",
+                    (self._max_entries,),
+                )
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
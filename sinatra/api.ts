@@ -29,6 +29,19 @@ const getServerlessApiPath = (path: string): string => {
   return `/api${path}`;
 };
 
+// Identifies this tab's pipeline state (latest drum, vocal, sample) on the backend
+const getSessionId = (): string => {
+  const existing = sessionStorage.getItem('sinatra-session-id');
+  if (existing) return existing;
+  const id = typeof crypto !== 'undefined' && 'randomUUID' in crypto
+    ? crypto.randomUUID()
+    : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+  sessionStorage.setItem('sinatra-session-id', id);
+  return id;
+};
+
+const sessionHeaders = (): Record<string, string> => ({ 'X-Session-ID': getSessionId() });
+
 export interface UploadDrumResponse {
   status: string;
   bpm: number;
@@ -50,6 +63,7 @@ export async function uploadDrum(file: File): Promise<UploadDrumResponse> {
 
   const response = await fetch(`${API_BASE}/upload-drum`, {
     method: 'POST',
+    headers: sessionHeaders(),
     body: formData,
   });
 
@@ -79,6 +93,7 @@ export async function uploadVocal(
 
   const response = await fetch(`${API_BASE}/upload-vocal`, {
     method: 'POST',
+    headers: sessionHeaders(),
     body: formData,
   });
 
@@ -107,6 +122,7 @@ export async function uploadSample(file: File): Promise<UploadSampleResponse> {
 
   const response = await fetch(`${API_BASE}/upload-sample`, {
     method: 'POST',
+    headers: sessionHeaders(),
     body: formData,
   });
 
@@ -128,6 +144,7 @@ export async function renderMidi(instrument: string): Promise<Blob> {
 
   const response = await fetch(`${API_BASE}/render`, {
     method: 'POST',
+    headers: sessionHeaders(),
     body: formData,
   });
 
@@ -150,6 +167,7 @@ export async function reRenderMidi(midiFilename: string, instrument: string): Pr
 
   const response = await fetch(`${API_BASE}/re-render`, {
     method: 'POST',
+    headers: sessionHeaders(),
     body: formData,
   });
 
@@ -193,7 +211,7 @@ export async function updateMidiNotes(
 ): Promise<Blob> {
   const response = await fetch(`${API_BASE}/update-midi-notes`, {
     method: 'POST',
-    headers: { 'Content-Type': 'application/json' },
+    headers: { 'Content-Type': 'application/json', ...sessionHeaders() },
     body: JSON.stringify({
       midi_filename: midiFilename,
       notes,
@@ -218,7 +236,7 @@ export async function previewMidiNotes(
 ): Promise<Blob> {
   const response = await fetch(`${API_BASE}/preview-midi-notes`, {
     method: 'POST',
-    headers: { 'Content-Type': 'application/json' },
+    headers: { 'Content-Type': 'application/json', ...sessionHeaders() },
     body: JSON.stringify({
       notes,
       instrument,
@@ -286,6 +304,7 @@ export async function processAll(
 
   const response = await fetch(`${API_BASE}/process-all`, {
     method: 'POST',
+    headers: sessionHeaders(),
     body: formData,
   });
 
@@ -384,7 +403,7 @@ export async function sendChatMessage(
   const apiPath = getServerlessApiPath('/chat');
   const response = await fetch(apiPath, {
     method: 'POST',
-    headers: { 'Content-Type': 'application/json' },
+    headers: { 'Content-Type': 'application/json', ...sessionHeaders() },
     body: JSON.stringify({ message, context }),
   });
 
@@ -402,5 +421,5 @@ export async function sendChatMessage(
  */
 export async function clearChatHistory(): Promise<void> {
   const apiPath = getServerlessApiPath('/chat/clear');
-  await fetch(apiPath, { method: 'POST' });
+  await fetch(apiPath, { method: 'POST', headers: sessionHeaders() });
 }